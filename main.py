@@ -6,24 +6,61 @@
 ╚══════════════════════════════════════════╝
 """
 
+import asyncio
+import functools
+import gzip
+import hashlib
+import hmac
+import json
 import logging
+import mimetypes
+import multiprocessing
 import os
+import re
 import secrets
+import select
+import shutil
+import subprocess
+import threading
+from time import monotonic
 from datetime import datetime, date, timedelta, time
 from zoneinfo import ZoneInfo
-from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 from typing import List, Dict, Any, Optional
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from fastapi import FastAPI, Request, UploadFile, File, Response
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Response
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from telegram import (
     Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup,
     WebAppInfo, MenuButtonWebApp
 )
 from telegram.constants import ChatType
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, ChatMigrated, Conflict, Forbidden, NetworkError, RetryAfter
+from telegram.request import BaseRequest, RequestData
+from telegram.ext import (
+    Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+)
+
+try:
+    import brotli  # опційно: .br-варіанти текстових файлів
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps  # опційно: мініатюри зображень
+except ImportError:
+    Image = None
+
+try:
+    import fitz  # PyMuPDF, опційно: прев'ю першої сторінки PDF
+except ImportError:
+    fitz = None
 
 # ==========================================
 # ⚙️ НАЛАШТУВАННЯ
@@ -36,14 +73,72 @@ if not TOKEN:
 WEB_APP_URL  = os.getenv("WEB_APP_URL",  os.getenv("RENDER_EXTERNAL_URL", "https://tg-0ncg.onrender.com"))
 WEBHOOK_URL  = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL") or "https://tg-0ncg.onrender.com"
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # без нього /metrics відповідає лише на localhost
 WEBHOOK_PATH = "/webhook/telegram"
 WEBHOOK_SECRET_ACTIVE = False
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Пул з'єднань PostgreSQL
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))          # сек очікування вільного з'єднання
+DB_HEALTHCHECK_IDLE = float(os.getenv("DB_HEALTHCHECK_IDLE", "30"))  # сек простою, після яких з'єднання перевіряється
+DB_EXPLAIN_CHECK = os.getenv("DB_EXPLAIN_CHECK", "0") == "1"          # перевіряти плани ключових запитів на старті
+
+# Кеш контексту щоденника користувача
+CTX_CACHE_TTL = float(os.getenv("CTX_CACHE_TTL", "300"))     # сек
+CTX_CACHE_TTL_NO_NOTIFY = float(os.getenv("CTX_CACHE_TTL_NO_NOTIFY", "15"))  # сек, коли інші воркери не можуть скинути кеш
+CTX_CACHE_SIZE = int(os.getenv("CTX_CACHE_SIZE", "10000"))   # записів (LRU)
+
+# Розсилка: Telegram дозволяє ~30 повідомлень/с на бота, ~1/с у приватний чат і ~20/хв у групу
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))              # повідомлень/с на весь бот (шле лише лідер)
+BROADCAST_PRIVATE_INTERVAL = 1.0                                       # сек між повідомленнями в один чат
+BROADCAST_GROUP_INTERVAL = 3.0                                         # сек між повідомленнями в одну групу
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "3"))
+
+# Outbox запланованих розсилок
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200"))          # рядків за одне захоплення
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", "300"))          # сек, після яких незавершений рядок береться знову
+OUTBOX_TTL_HOURS = int(os.getenv("OUTBOX_TTL_HOURS", "6"))    # після цього ненадіслане повідомлення вже не актуальне
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "3"))
+OUTBOX_RETRY_BASE = int(os.getenv("OUTBOX_RETRY_BASE", "30"))  # сек до першого повтору, далі ×2 за спробу
+OUTBOX_KEEP_DAYS = 7                                           # скільки днів зберігати оброблені рядки
+
+# Стрічка змін Д/З (SSE) і синхронізація воркерів через LISTEN/NOTIFY
+HW_FEED_NOTIFY = os.getenv("HW_FEED_NOTIFY", "1") == "1"
+HW_FEED_CHANNEL = "hw_changes"
+HW_FEED_QUEUE_SIZE = 64      # подій у черзі одного клієнта до примусової ресинхронізації
+HW_FEED_HEARTBEAT = 20       # сек між keep-alive коментарями SSE
+
 UPLOAD_DIR = "uploads"
 START_WEBAPP = WEB_APP_URL
+TEMPLATE_PATH = "templates/index.html"
+TEMPLATE_RELOAD = os.getenv("TEMPLATE_RELOAD", "0") == "1"  # dev: перечитувати шаблон, якщо файл змінився
 MAX_UPLOAD_MB = 60
 MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_CHUNK_KB = int(os.getenv("UPLOAD_CHUNK_KB", "1024"))  # розмір шматка при копіюванні upload на диск
+UPLOAD_GRACE_MIN = int(os.getenv("UPLOAD_GRACE_MIN", "60"))  # свіжі блоби (ще не прив'язані до Д/З) не видаляються
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "1") == "1"  # кілька воркерів: розклад задач і webhook — лише в лідера
+LEADER_POLL_SEC = float(os.getenv("LEADER_POLL_SEC", "15"))  # як часто послідовники пробують стати лідером
+LEADER_CATCHUP_HOURS = float(os.getenv("LEADER_CATCHUP_HOURS", "4"))  # наскільки пізно новий лідер доганяє пропущені розсилки
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # оновлень Telegram у черзі воркера (далі — 503)
+UPDATE_MAX_IN_FLIGHT = int(os.getenv("UPDATE_MAX_IN_FLIGHT", "32"))  # оновлень різних чатів, що обробляються одночасно
+BOT_RUN_MODE = os.getenv("BOT_RUN_MODE", "webhook").strip().lower()  # webhook | polling | replay
+POLL_LIMIT = min(100, max(1, int(os.getenv("POLL_LIMIT", "100"))))  # оновлень за один getUpdates
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))          # long polling, с
+REPLAY_FILE = os.getenv("REPLAY_FILE", "")                   # JSON Lines із записаними оновленнями
+REPLAY_LOOPS = max(1, int(os.getenv("REPLAY_LOOPS", "1")))   # скільки разів програти файл
+REPLAY_OFFLINE = os.getenv("REPLAY_OFFLINE", "1") == "1"     # не ходити в Telegram API під час replay
+REPLAY_API_LATENCY_MS = int(os.getenv("REPLAY_API_LATENCY_MS", "0"))  # імітована затримка API в offline-режимі
+FILE_IO_WORKERS = int(os.getenv("FILE_IO_WORKERS", "4"))    # потоки для дискових операцій сховища
+GC_INTERVAL_MIN = int(os.getenv("GC_INTERVAL_MIN", "10"))    # як часто запускати прибирання сховища
+GC_SHARDS_PER_RUN = int(os.getenv("GC_SHARDS_PER_RUN", "16"))  # скільки з 256 каталогів верхнього рівня за запуск
+GC_BATCH = int(os.getenv("GC_BATCH", "500"))                 # імен на один запит до attachments
+CLEANUP_BATCH = int(os.getenv("CLEANUP_BATCH", "500"))       # Д/З, що видаляються однією транзакцією
+CLEANUP_ARCHIVE = os.getenv("CLEANUP_ARCHIVE", "0") == "1"   # копіювати старі Д/З у homework_archive перед видаленням
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))  # процеси для генерації прев'ю (0 — вимкнено)
+THUMB_SIZE = int(os.getenv("THUMB_SIZE", "320"))      # довша сторона прев'ю, px
 
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(name)s: %(message)s", level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -80,35 +175,22 @@ SCHEDULE_9 = {
 
 MIX_LESSONS_9 = {1: "Історія України", 2: None, 3: "Всесвітня Історія", 4: None}
 
+def _mix_thursday(ref_date: date) -> date:
+    # Четвер, що визначає "Мікс": найближчий з ref_date (з п'ятниці — вже наступного тижня)
+    return ref_date + timedelta(days=(3 - ref_date.weekday()) % 7)
+
 def resolve_mix_for_week(ref_date: date) -> Optional[str]:
     """Повертає фактичний урок 'Мікс' для тижня, що містить ref_date."""
-    # Знаходимо четвер цього тижня
-    thursday = ref_date + timedelta(days=(3 - ref_date.weekday()) % 7)
-    week_of_month = (thursday.day - 1) // 7 + 1
-    return MIX_LESSONS_9.get(week_of_month, None)
+    return resolve_mix("9", ref_date)
 
 def get_resolved_schedule_9(ref_date: date) -> dict:
     """Повертає розклад 9 класу з розрахованим уроком 'Мікс' для заданої дати."""
-    mix = resolve_mix_for_week(ref_date)
-    resolved = {}
-    for day, subjects in SCHEDULE_9.items():
-        if day == "Четвер":
-            day_subjects = []
-            for s in subjects:
-                if s == "Мікс":
-                    if mix:
-                        day_subjects.append(mix)
-                    # якщо mix is None — урок відсутній, просто пропускаємо
-                else:
-                    day_subjects.append(s)
-            resolved[day] = day_subjects
-        else:
-            resolved[day] = subjects
-    return resolved
+    return resolved_schedule("9", ref_date)
 
 # Для зворотної сумісності
 SCHEDULE = SCHEDULE_11
 
+# Початкові розклади: засівають таблицю schedules і слугують запасним варіантом без БД
 SCHEDULES: Dict[str, dict] = {
     "11": SCHEDULE_11,
     "9":  SCHEDULE_9,
@@ -134,13 +216,252 @@ EMOJI = {
 def ei(s): return EMOJI.get(s, "📌")
 def day_name(d: date): return DAYS_UA[d.weekday()]
 
+# ==========================================
+# 📆 РЕЄСТР РОЗКЛАДІВ
+# ==========================================
+# Розклади (уроки, дзвінки, правила "Мікс") живуть у таблиці schedules, по ключу на щоденник.
+# У пам'яті тримається скомпільована копія; version — найбільший schedules.version, тож
+# кешовані рендери, прив'язані до версії, застарівають самі після перезавантаження.
+MIX_RULES: Dict[str, Dict[int, Optional[str]]] = {"9": MIX_LESSONS_9}
+SCHEDULE_POLL_SEC = int(os.getenv("SCHEDULE_POLL_SEC", "60"))  # перевірка версії розкладів (крім NOTIFY)
+
+
+def _compile_schedule(days: dict, bells, mix_rules) -> Dict[str, Any]:
+    return {
+        "days": {day: list(subjects) for day, subjects in days.items()},
+        "bells": tuple((int(n), str(s), str(e)) for n, s, e in (bells or BELLS)),
+        "mix": {int(k): v for k, v in (mix_rules or {}).items()},
+    }
+
+
+class ScheduleRegistry:
+    def __init__(self):
+        self.version = 0
+        self._by_key: Dict[str, Dict[str, Any]] = {
+            key: _compile_schedule(days, BELLS, MIX_RULES.get(key)) for key, days in SCHEDULES.items()
+        }
+
+    def get(self, key: Optional[str]) -> Dict[str, Any]:
+        return self._by_key.get(key or "11") or self._by_key["11"]
+
+    def load(self):
+        with dbc() as c:
+            rows = c.execute("SELECT key, days, bells, mix_rules, version FROM schedules").fetchall()
+        compiled = dict(self._by_key)
+        version = 0
+        for r in rows:
+            compiled[r["key"]] = _compile_schedule(r["days"], r["bells"], r["mix_rules"])
+            version = max(version, int(r["version"]))
+        # Одне присвоєння — читачі бачать або старий, або новий набір
+        self._by_key, self.version = compiled, version
+        log.info("📆 Розклади завантажено: %d (версія %d)", len(compiled), version)
+
+    def refresh_if_stale(self) -> bool:
+        with dbc() as c:
+            v = int(c.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schedules").fetchone()["v"])
+        if v != self.version:
+            self.load()
+            return True
+        return False
+
+
+SCHEDULE_REGISTRY = ScheduleRegistry()
+
+
+def schedule_days(schedule_key: Optional[str]) -> Dict[str, list]:
+    return SCHEDULE_REGISTRY.get(schedule_key)["days"]
+
+
+def resolve_mix(schedule_key: Optional[str], ref_date: date) -> Optional[str]:
+    thursday = _mix_thursday(ref_date)
+    return SCHEDULE_REGISTRY.get(schedule_key)["mix"].get((thursday.day - 1) // 7 + 1)
+
+
+def resolved_schedule(schedule_key: Optional[str], ref_date: date) -> Dict[str, list]:
+    """Розклад із підставленим 'Мікс' для тижня ref_date. Результат спільний — не змінювати."""
+    return _resolved_for_week(schedule_key, _mix_thursday(ref_date), SCHEDULE_REGISTRY.version)
+
+@functools.lru_cache(maxsize=256)
+def _resolved_for_week(schedule_key: Optional[str], thursday: date, version: int) -> Dict[str, list]:
+    sched = SCHEDULE_REGISTRY.get(schedule_key)
+    if not sched["mix"]:
+        return sched["days"]
+    mix = sched["mix"].get((thursday.day - 1) // 7 + 1)
+    # якщо mix is None — урок відсутній, просто пропускаємо
+    return {day: [mix if s == "Мікс" else s for s in subjects if s != "Мікс" or mix]
+            for day, subjects in sched["days"].items()}
+
+
+# ── Готові текстові блоки розкладу: рахуються раз на (розклад, день, тиждень, стиль, версію) ──
+def render_day(schedule_key: Optional[str], day: str, ref_date: date, style: str = "menu") -> str:
+    """Markdown-блок уроків дня: style="menu" — для меню розкладу, "morning" — для ранкової розсилки."""
+    return _render_day(schedule_key, day, _mix_thursday(ref_date), style, SCHEDULE_REGISTRY.version)
+
+@functools.lru_cache(maxsize=1024)
+def _render_day(schedule_key: Optional[str], day: str, thursday: date, style: str, version: int) -> str:
+    subjects = _resolved_for_week(schedule_key, thursday, version).get(day, [])
+    parts = []
+    lesson_idx = 0
+    for num, start, end in SCHEDULE_REGISTRY.get(schedule_key)["bells"]:
+        if num == 0:
+            if style == "menu":
+                parts.append(f"\n╭─ 🍽  *Обідня перерва*\n╰─ {start} – {end}\n\n")
+            else:
+                parts.append(f"   ☕ Перерва {start}–{end}\n")
+        elif lesson_idx < len(subjects):
+            s = subjects[lesson_idx]
+            sep = " – " if style == "menu" else "–"
+            parts.append(f"╭─ *{num}.* {ei(s)} {s}\n╰─ {start}{sep}{end}\n")
+            lesson_idx += 1
+    return "".join(parts)
+
+
+_TIME_RE = re.compile(r"^\d{2}:\d{2}$")
+
+def validate_schedule(days, bells=None, mix_rules=None) -> Optional[str]:
+    """Перевіряє розклад з API; повертає текст помилки або None."""
+    if not isinstance(days, dict) or not days:
+        return "days must be a non-empty object"
+    for day, subjects in days.items():
+        if day not in DAYS_UA:
+            return f"unknown day: {day}"
+        if not isinstance(subjects, list) or not all(isinstance(x, str) and x.strip() for x in subjects):
+            return f"lessons of {day} must be a list of names"
+    if bells is not None:
+        if not isinstance(bells, list) or not bells:
+            return "bells must be a non-empty list"
+        for b in bells:
+            if not (isinstance(b, list) and len(b) == 3 and isinstance(b[0], int)
+                    and all(isinstance(t, str) and _TIME_RE.match(t) for t in b[1:])):
+                return "each bell must be [number, 'HH:MM', 'HH:MM']"
+    if mix_rules is not None:
+        if not isinstance(mix_rules, dict) or not all(
+                str(k).isdigit() and 1 <= int(k) <= 5 and (v is None or isinstance(v, str))
+                for k, v in mix_rules.items()):
+            return "mix_rules must map week of month (1-5) to a lesson or null"
+    return None
+
+
+def schedule_save(key: str, days: dict, bells=None, mix_rules=None) -> int:
+    """Зберігає розклад під ключем і перезавантажує реєстр тут і (через NOTIFY) в інших воркерах."""
+    with dbc() as c:
+        version = c.execute("""
+            INSERT INTO schedules(key, days, bells, mix_rules) VALUES(%s,%s,%s,%s)
+            ON CONFLICT (key) DO UPDATE SET days=EXCLUDED.days, bells=EXCLUDED.bells,
+                mix_rules=EXCLUDED.mix_rules, version=nextval('schedules_version_seq'),
+                updated_at=CURRENT_TIMESTAMP
+            RETURNING version
+        """, (key, Json(days), Json(bells) if bells else None,
+              Json(mix_rules) if mix_rules else None)).fetchone()["version"]
+    SCHEDULE_REGISTRY.load()
+    feed_notify({"op": "schedules"})
+    return int(version)
+
+
 # ==========================================
 # 🗄 БАЗА ДАНИХ
 # ==========================================
+class DBPool:
+    """Пул з'єднань з очікуванням вільного слота, перевіркою здоров'я та метриками."""
+
+    def __init__(self, url, minconn: int, maxconn: int, timeout: float, healthcheck_idle: float):
+        self._pool = ThreadedConnectionPool(minconn, maxconn, url, cursor_factory=RealDictCursor)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used: Dict[int, float] = {}
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._stats = {
+            "checkouts": 0, "in_use": 0, "timeouts": 0, "reconnects": 0,
+            "wait_total_ms": 0.0, "wait_max_ms": 0.0,
+        }
+
+    def getconn(self):
+        t0 = monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolError(f"❌ Немає вільного з'єднання з БД за {self.timeout:g} с")
+        try:
+            conn = self._healthy(self._pool.getconn())
+        except Exception:
+            self._slots.release()
+            raise
+        waited_ms = (monotonic() - t0) * 1000
+        with self._lock:
+            st = self._stats
+            st["checkouts"] += 1
+            st["in_use"] += 1
+            st["wait_total_ms"] += waited_ms
+            st["wait_max_ms"] = max(st["wait_max_ms"], waited_ms)
+        return conn
+
+    def _healthy(self, conn):
+        """Перевіряє з'єднання, яке довго простоювало; мертве замінює наступним, доки не знайде живе.
+
+        Після рестарту БД мертві всі з'єднання в пулі, тож заміну теж перевіряємо: за maxconn + 1
+        спроб пул гарантовано спорожніє і видасть свіже з'єднання (або помилку підключення).
+        """
+        for _ in range(self.maxconn + 1):
+            last = self._last_used.get(id(conn))
+            if not (conn.closed or last is None or monotonic() - last > self.healthcheck_idle):
+                break
+            try:
+                if conn.closed:
+                    raise psycopg2.InterfaceError("connection already closed")
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                break
+            except psycopg2.Error:
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+                with self._lock:
+                    self._stats["reconnects"] += 1
+        else:
+            self._pool.putconn(conn, close=True)
+            raise PoolError("❌ Не вдалося отримати живе з'єднання з БД")
+        conn.autocommit = True
+        return conn
+
+    def putconn(self, conn, broken: bool = False):
+        try:
+            if not broken and not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        close = broken or bool(conn.closed)
+        try:
+            if close:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = monotonic()
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            st = dict(self._stats)
+        st["min"] = self.minconn
+        st["max"] = self.maxconn
+        st["wait_avg_ms"] = round(st["wait_total_ms"] / st["checkouts"], 3) if st["checkouts"] else 0.0
+        st["wait_total_ms"] = round(st["wait_total_ms"], 3)
+        st["wait_max_ms"] = round(st["wait_max_ms"], 3)
+        return st
+
+    def close(self):
+        self._pool.closeall()
+
+
 class DBWrapper:
-    def __init__(self, url):
-        self.conn = psycopg2.connect(url, cursor_factory=RealDictCursor)
-        self.conn.autocommit = True
+    def __init__(self, pool: DBPool):
+        self._pool = pool
+        self.conn = pool.getconn()
 
     def execute(self, query, params=None):
         cur = self.conn.cursor()
@@ -150,102 +471,363 @@ class DBWrapper:
             cur.execute(query)
         return cur
 
+    @contextmanager
+    def transaction(self):
+        """Явна транзакція поверх autocommit-з'єднання."""
+        self.conn.autocommit = False
+        try:
+            yield self
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.autocommit = True
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        broken = isinstance(exc_val, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        self._pool.putconn(self.conn, broken=broken)
 
-def dbc():
+
+DB_POOL: Optional[DBPool] = None
+_DB_POOL_LOCK = threading.Lock()
+
+def db_pool() -> DBPool:
+    global DB_POOL
     if not DATABASE_URL:
         raise RuntimeError("❌ DATABASE_URL не задано!")
-    return DBWrapper(DATABASE_URL)
+    if DB_POOL is None:
+        with _DB_POOL_LOCK:
+            if DB_POOL is None:
+                DB_POOL = DBPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_HEALTHCHECK_IDLE)
+                log.info("🗄 Пул з'єднань БД: min=%d max=%d", DB_POOL_MIN, DB_POOL_MAX)
+    return DB_POOL
+
+def close_db_pool():
+    global DB_POOL
+    with _DB_POOL_LOCK:
+        if DB_POOL is not None:
+            DB_POOL.close()
+            DB_POOL = None
+
+def dbc():
+    return DBWrapper(db_pool())
+
+
+# ── Асинхронний доступ: синхронні запити виконуються в обмеженому пулі потоків ──
+# Розмір пулу дорівнює DB_POOL_MAX, тож потоки ніколи не чекають на з'єднання довше, ніж потрібно,
+# а event loop uvicorn/PTB не блокується жодним запитом.
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+_DB_EXEC_STATS = {"submitted": 0, "pending": 0, "errors": 0}
+
+async def run_db(fn, *args, **kwargs):
+    """Виконує синхронну функцію роботи з БД у пулі потоків і повертає результат."""
+    loop = asyncio.get_running_loop()
+    _DB_EXEC_STATS["submitted"] += 1
+    _DB_EXEC_STATS["pending"] += 1
+    try:
+        return await loop.run_in_executor(_DB_EXECUTOR, functools.partial(fn, *args, **kwargs))
+    except Exception:
+        _DB_EXEC_STATS["errors"] += 1
+        raise
+    finally:
+        _DB_EXEC_STATS["pending"] -= 1
 
 def init_db():
     os.makedirs(UPLOAD_DIR, exist_ok=True)
     if not DATABASE_URL:
         return
 
+    migrate()
+    SCHEDULE_REGISTRY.load()
+
+    # Seed: створюємо щоденник 9 класу для користувача 5331432346
+    _ensure_9th_grade_diary()
+
+    if DB_EXPLAIN_CHECK:
+        for problem in check_query_plans():
+            log.warning("⚠️ Запит без індексу: %s", problem)
+
+
+# ==========================================
+# 🗄 МІГРАЦІЇ СХЕМИ
+# ==========================================
+# Кожна міграція застосовується рівно один раз, в окремій транзакції, під advisory-lock
+# (кілька воркерів можуть стартувати одночасно). Нові зміни схеми — лише новим номером в кінці.
+MIGRATION_LOCK_KEY = 715_001
+
+MIGRATIONS: List[tuple] = [
+    (1, "baseline", [
+        """
+        CREATE TABLE IF NOT EXISTS homework(
+            id SERIAL PRIMARY KEY,
+            subject TEXT NOT NULL,
+            description TEXT NOT NULL,
+            due_date TEXT NOT NULL,
+            author_id BIGINT,
+            author_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_done INTEGER DEFAULT 0,
+            is_important INTEGER DEFAULT 0,
+            diary_id INTEGER
+        )
+        """,
+        "ALTER TABLE homework ADD COLUMN IF NOT EXISTS is_important INTEGER DEFAULT 0",
+        "ALTER TABLE homework ADD COLUMN IF NOT EXISTS diary_id INTEGER",
+        """
+        CREATE TABLE IF NOT EXISTS subscribers(
+            chat_id BIGINT PRIMARY KEY,
+            username TEXT,
+            mode TEXT DEFAULT 'private',
+            title TEXT
+        )
+        """,
+        "ALTER TABLE subscribers ADD COLUMN IF NOT EXISTS enabled INTEGER DEFAULT 1",
+        """
+        CREATE TABLE IF NOT EXISTS attachments(
+            id SERIAL PRIMARY KEY,
+            hw_id INTEGER NOT NULL REFERENCES homework(id) ON DELETE CASCADE,
+            original_name TEXT NOT NULL,
+            stored_name TEXT NOT NULL UNIQUE,
+            mime_type TEXT,
+            size_bytes INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS diaries(
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            grade TEXT NOT NULL DEFAULT '9',
+            owner_id BIGINT,
+            schedule_key TEXT DEFAULT '9',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS diary_members(
+            diary_id INTEGER NOT NULL REFERENCES diaries(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            role TEXT DEFAULT 'member',
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (diary_id, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS diary_invites(
+            code TEXT PRIMARY KEY,
+            diary_id INTEGER NOT NULL REFERENCES diaries(id) ON DELETE CASCADE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+        """,
+        # Outbox розсилок: (run_key, chat_id) унікальні → повторний запуск не дублює
+        """
+        CREATE TABLE IF NOT EXISTS outbox(
+            id BIGSERIAL PRIMARY KEY,
+            run_key TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP,
+            locked_until TIMESTAMP,
+            sent_at TIMESTAMP,
+            UNIQUE (run_key, chat_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS outbox_open_idx ON outbox(id) WHERE status IN ('pending','sending')",
+    ]),
+    (2, "homework.due_date TEXT → DATE", [
+        # Базова схема не перевіряла due_date: один кривий рядок зірвав би приведення типу і старт
+        # усіх воркерів. Такі рядки переносимо в карантин (сирий текст зберігається), а дату
+        # підставляємо з created_at — запис лишається видимим і з часом піде в автоочищення.
+        """
+        CREATE TABLE IF NOT EXISTS homework_bad_due(
+            hw_id INTEGER PRIMARY KEY,
+            raw_due TEXT NOT NULL,
+            quarantined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        r"""
+        DO $$
+        DECLARE
+            r RECORD;
+            bad INTEGER := 0;
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_name='homework' AND column_name='due_date') <> 'text' THEN
+                RETURN;
+            END IF;
+            FOR r IN SELECT id, due_date FROM homework
+                     WHERE due_date !~ '^\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])$'
+                        OR substr(due_date, 9, 2) > '28' OR due_date LIKE '0000%' LOOP
+                BEGIN
+                    IF r.due_date !~ '^\d{4}-\d{2}-\d{2}$' THEN
+                        RAISE SQLSTATE '22007';
+                    END IF;
+                    PERFORM r.due_date::date;  -- ловить 2024-02-30 і подібні
+                EXCEPTION WHEN invalid_datetime_format OR datetime_field_overflow THEN
+                    INSERT INTO homework_bad_due(hw_id, raw_due) VALUES (r.id, r.due_date)
+                    ON CONFLICT (hw_id) DO NOTHING;
+                    UPDATE homework SET due_date = COALESCE(created_at, NOW())::date::text WHERE id = r.id;
+                    bad := bad + 1;
+                END;
+            END LOOP;
+            IF bad > 0 THEN
+                RAISE WARNING 'homework.due_date: % некоректних рядків перенесено в homework_bad_due', bad;
+            END IF;
+            ALTER TABLE homework ALTER COLUMN due_date TYPE DATE USING due_date::date;
+        END $$
+        """,
+    ]),
+    (3, "індекси для вибірок Д/З, вкладень і учасників", [
+        "CREATE INDEX IF NOT EXISTS homework_diary_due_idx ON homework(diary_id, due_date)",
+        "CREATE INDEX IF NOT EXISTS homework_default_due_idx ON homework(due_date) WHERE diary_id IS NULL",
+        "CREATE INDEX IF NOT EXISTS homework_due_idx ON homework(due_date)",
+        "CREATE INDEX IF NOT EXISTS attachments_hw_id_idx ON attachments(hw_id)",
+        "CREATE INDEX IF NOT EXISTS diary_members_user_idx ON diary_members(user_id)",
+    ]),
+    (4, "вкладення: один блоб на кілька записів", [
+        # stored_name тепер — хеш вмісту, тож один файл може мати багато посилань
+        "ALTER TABLE attachments DROP CONSTRAINT IF EXISTS attachments_stored_name_key",
+        "CREATE INDEX IF NOT EXISTS attachments_stored_name_idx ON attachments(stored_name)",
+    ]),
+    (5, "прев'ю вкладень", [
+        """
+        CREATE TABLE IF NOT EXISTS blob_thumbs(
+            stored_name TEXT PRIMARY KEY,
+            thumb_name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (6, "архів старих Д/З", [
+        """
+        CREATE TABLE IF NOT EXISTS homework_archive(
+            id INTEGER PRIMARY KEY,
+            diary_id INTEGER,
+            subject TEXT NOT NULL,
+            description TEXT NOT NULL,
+            due_date DATE NOT NULL,
+            author_id BIGINT,
+            author_name TEXT,
+            is_important INTEGER DEFAULT 0,
+            created_at TIMESTAMP,
+            attachments JSONB NOT NULL DEFAULT '[]',
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (7, "розклади в БД", [
+        "CREATE SEQUENCE IF NOT EXISTS schedules_version_seq",
+        """
+        CREATE TABLE IF NOT EXISTS schedules(
+            key TEXT PRIMARY KEY,
+            days JSONB NOT NULL,
+            bells JSONB,
+            mix_rules JSONB,
+            version BIGINT NOT NULL DEFAULT nextval('schedules_version_seq'),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        *[("INSERT INTO schedules(key, days, bells, mix_rules) VALUES(%s,%s,%s,%s) ON CONFLICT (key) DO NOTHING",
+           (key, Json(days), Json(BELLS), Json(MIX_RULES[key]) if key in MIX_RULES else None))
+          for key, days in SCHEDULES.items()],
+    ]),
+    (8, "версії Д/З для ETag", [
+        # Спільна для всіх воркерів версія: ETag не залежить від того, чи дійшов NOTIFY
+        """
+        CREATE TABLE IF NOT EXISTS hw_versions(
+            diary_key BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (9, "outbox: відкладені повтори", [
+        "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP",
+    ]),
+]
+
+
+def migrate():
     with dbc() as c:
-        # ── Основні таблиці ──────────────────────────────────────────────────
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS homework(
-                id SERIAL PRIMARY KEY,
-                subject TEXT NOT NULL,
-                description TEXT NOT NULL,
-                due_date TEXT NOT NULL,
-                author_id BIGINT,
-                author_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_done INTEGER DEFAULT 0,
-                is_important INTEGER DEFAULT 0,
-                diary_id INTEGER
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS subscribers(
-                chat_id BIGINT PRIMARY KEY,
-                username TEXT,
-                mode TEXT DEFAULT 'private',
-                title TEXT
-            )
-        """)
-        c.execute("ALTER TABLE subscribers ADD COLUMN IF NOT EXISTS enabled INTEGER DEFAULT 1")
+        with c.transaction():
+            # Паралельні CREATE TABLE IF NOT EXISTS на свіжій БД можуть впасти на pg_type_typname_nsp_index,
+            # тож і службову таблицю створюємо під тим самим lock, що й міграції
+            c.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations(
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+        for version, name, statements in MIGRATIONS:
+            with c.transaction():
+                c.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+                if c.execute("SELECT 1 FROM schema_migrations WHERE version=%s", (version,)).fetchone():
+                    continue
+                t0 = monotonic()
+                for sql in statements:
+                    # Рядок — DDL; кортеж (sql, params) — засів даних
+                    if isinstance(sql, tuple):
+                        c.execute(*sql)
+                    else:
+                        c.execute(sql)
+                c.execute("INSERT INTO schema_migrations(version, name) VALUES(%s,%s)", (version, name))
+                for notice in c.conn.notices:
+                    if notice.startswith("WARNING"):  # NOTICE «already exists, skipping» не цікаві
+                        log.warning("🗄 Міграція %d: %s", version, notice.strip())
+                del c.conn.notices[:]
+            log.info("🗄 Міграція %d (%s) застосована за %.2f с", version, name, monotonic() - t0)
+
+
+# ── Регресійна перевірка планів: ключові запити мають обслуговуватись індексами ──
+_PLAN_CHECKED_TABLES = {"homework", "attachments", "diary_members"}
+
+def _plan_queries() -> List[tuple]:
+    d = today_kyiv().isoformat()
+    return [
+        ("hw_range (11 клас)", _HW_RANGE_SQL.format(where="h.due_date >= %s AND h.due_date <= %s AND h.diary_id IS NULL"), [d, d]),
+        ("hw_range (щоденник)", _HW_RANGE_SQL.format(where="h.due_date >= %s AND h.diary_id = %s"), [d, 1]),
+        ("hw_by_diary", _HW_RANGE_SQL.format(where="h.due_date = %s"), [d]),
+        ("hw_cleanup", "SELECT id FROM homework WHERE due_date < %s", [d]),
+        ("user context", "SELECT diary_id FROM diary_members WHERE user_id=%s LIMIT 1", [1]),
+    ]
 
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS attachments(
-                id SERIAL PRIMARY KEY,
-                hw_id INTEGER NOT NULL REFERENCES homework(id) ON DELETE CASCADE,
-                original_name TEXT NOT NULL,
-                stored_name TEXT NOT NULL UNIQUE,
-                mime_type TEXT,
-                size_bytes INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
 
-        # ── Щоденники (multi-diary) ───────────────────────────────────────────
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS diaries(
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                grade TEXT NOT NULL DEFAULT '9',
-                owner_id BIGINT,
-                schedule_key TEXT DEFAULT '9',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS diary_members(
-                diary_id INTEGER NOT NULL REFERENCES diaries(id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL,
-                role TEXT DEFAULT 'member',
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (diary_id, user_id)
-            )
-        """)
+def _seq_scans(plan: dict) -> List[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in _PLAN_CHECKED_TABLES:
+        found.append(plan["Relation Name"])
+    for sub in plan.get("Plans", []):
+        found.extend(_seq_scans(sub))
+    return found
 
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS diary_invites(
-                code TEXT PRIMARY KEY,
-                diary_id INTEGER NOT NULL REFERENCES diaries(id) ON DELETE CASCADE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP NOT NULL
-            )
-        """)
 
-        # ── Міграції ─────────────────────────────────────────────────────────
-        try:
-            c.execute("ALTER TABLE homework ADD COLUMN is_important INTEGER DEFAULT 0")
-        except Exception:
-            pass
-        try:
-            c.execute("ALTER TABLE homework ADD COLUMN diary_id INTEGER")
-        except Exception:
-            pass
+def check_query_plans() -> List[str]:
+    """EXPLAIN ключових запитів з enable_seqscan=off; повертає ті, що все одно читають таблицю повністю.
 
-    # Seed: створюємо щоденник 9 класу для користувача 5331432346
-    _ensure_9th_grade_diary()
+    Вимкнений seqscan змушує планувальник обрати індекс, якщо він узагалі придатний,
+    тож перевірка не залежить від того, скільки даних зараз у таблицях.
+    """
+    problems = []
+    with dbc() as c:
+        with c.transaction():
+            c.execute("SET LOCAL enable_seqscan = off")
+            for name, sql, params in _plan_queries():
+                plan = c.execute("EXPLAIN (FORMAT JSON) " + sql, params).fetchone()["QUERY PLAN"]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                tables = _seq_scans(plan[0]["Plan"])
+                if tables:
+                    problems.append(f"{name}: Seq Scan on {', '.join(sorted(set(tables)))}")
+    return problems
 
 
 # ==========================================
@@ -275,7 +857,95 @@ def _ensure_9th_grade_diary() -> int:
             (diary_id, DIARY_9_OWNER)
         )
         log.info("✅ Щоденник 9 класу створено (id=%d)", diary_id)
-        return diary_id
+    invalidate_user_context(DIARY_9_OWNER)
+    return diary_id
+
+
+class TTLCache:
+    """Потокобезпечний LRU-кеш із часом життя записів і лічильниками влучань."""
+
+    MISS = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Покоління інвалідацій: set(since=...) не запише значення, прочитане до скидання ключа
+        self._gen = 0
+        self._invalidated: "OrderedDict[Any, int]" = OrderedDict()
+        self._invalidated_floor = 0  # покоління найсвіжішого витісненого з _invalidated запису
+        self.hits = self.misses = self.evictions = self.invalidations = self.stale_sets = 0
+
+    def generation(self) -> int:
+        """Знімок покоління — брати ДО читання з джерела і передати в set(since=...)."""
+        with self._lock:
+            return self._gen
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return self.MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, since: Optional[int] = None):
+        with self._lock:
+            if since is not None and self._invalidated.get(key, self._invalidated_floor) > since:
+                self.stale_sets += 1  # ключ скинули, поки значення читалось — воно вже застаріле
+                return
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._gen += 1
+            self._invalidated[key] = self._gen
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.maxsize:
+                _, gen = self._invalidated.popitem(last=False)
+                self._invalidated_floor = max(self._invalidated_floor, gen)
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._gen += 1
+            self._invalidated.clear()
+            self._invalidated_floor = self._gen
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions, "invalidations": self.invalidations, "stale_sets": self.stale_sets,
+            }
+
+
+# Без NOTIFY зміни членства з інших воркерів сюди не дійдуть — тоді кеш живе лише кілька секунд
+_CTX_CACHE = TTLCache(
+    CTX_CACHE_SIZE,
+    CTX_CACHE_TTL if HW_FEED_NOTIFY else min(CTX_CACHE_TTL, CTX_CACHE_TTL_NO_NOTIFY),
+)
+
+
+def invalidate_user_context(user_id: int, broadcast: bool = True):
+    """Скидає кеш контексту користувача тут і (через NOTIFY) в інших воркерах."""
+    _CTX_CACHE.invalidate(int(user_id))
+    if broadcast:
+        feed_notify({"op": "ctx", "user": int(user_id)})
 
 
 def get_user_diary_context(user_id: Optional[int]) -> dict:
@@ -290,6 +960,11 @@ def get_user_diary_context(user_id: Optional[int]) -> dict:
     if not user_id:
         return default_ctx
 
+    cached = _CTX_CACHE.get(user_id)
+    if cached is not TTLCache.MISS:
+        return dict(cached)   # копія: викликачі можуть змінювати контекст
+
+    since = _CTX_CACHE.generation()
     try:
         with dbc() as c:
             row = c.execute(
@@ -301,18 +976,39 @@ def get_user_diary_context(user_id: Optional[int]) -> dict:
                 (user_id,)
             ).fetchone()
     except Exception:
-        return default_ctx
+        return default_ctx   # помилку БД не кешуємо
 
-    if not row:
-        return default_ctx
-
-    return {
+    ctx = default_ctx if not row else {
         "diary_id": int(row["diary_id"]),
         "is_diary_admin": (row["role"] == "admin"),
         "grade": row["grade"],
         "schedule_key": row["schedule_key"] or "9",
         "name": row["name"],
     }
+    _CTX_CACHE.set(user_id, ctx, since=since)
+    return dict(ctx)
+
+
+def diary_get(diary_id: int) -> Optional[dict]:
+    with dbc() as c:
+        return c.execute(
+            "SELECT id, name, grade, schedule_key FROM diaries WHERE id=%s",
+            (diary_id,)
+        ).fetchone()
+
+
+def diaries_all() -> list:
+    with dbc() as c:
+        return c.execute("SELECT id, name, grade, schedule_key FROM diaries ORDER BY id").fetchall()
+
+
+def diary_admin_id(diary_id: int) -> Optional[int]:
+    with dbc() as c:
+        row = c.execute(
+            "SELECT user_id FROM diary_members WHERE diary_id=%s AND role='admin' LIMIT 1",
+            (diary_id,)
+        ).fetchone()
+    return int(row["user_id"]) if row else None
 
 
 def diary_get_members(diary_id: int) -> list:
@@ -332,6 +1028,7 @@ def diary_add_member(diary_id: int, user_id: int, role: str = "member") -> bool:
                    ON CONFLICT (diary_id, user_id) DO UPDATE SET role=EXCLUDED.role""",
                 (diary_id, user_id, role)
             )
+        invalidate_user_context(user_id)
         return True
     except Exception as e:
         log.error("diary_add_member error: %s", e)
@@ -345,6 +1042,7 @@ def diary_remove_member(diary_id: int, user_id: int) -> bool:
                 "DELETE FROM diary_members WHERE diary_id=%s AND user_id=%s AND role!='admin'",
                 (diary_id, user_id)
             )
+        invalidate_user_context(user_id)
         return True
     except Exception as e:
         log.error("diary_remove_member error: %s", e)
@@ -373,11 +1071,11 @@ def use_diary_invite(code: str, user_id: int) -> Optional[int]:
                 "SELECT diary_id FROM diary_invites WHERE code=%s AND expires_at > NOW()",
                 (code,)
             ).fetchone()
-            if not row:
-                return None
-            diary_id = int(row["diary_id"])
-            diary_add_member(diary_id, user_id, "member")
-            return diary_id
+        if not row:
+            return None
+        diary_id = int(row["diary_id"])
+        diary_add_member(diary_id, user_id, "member")
+        return diary_id
     except Exception as e:
         log.error("use_diary_invite error: %s", e)
         return None
@@ -386,10 +1084,73 @@ def use_diary_invite(code: str, user_id: int) -> Optional[int]:
 # ==========================================
 # 🗄 HOMEWORK — основні функції
 # ==========================================
+_CLEANUP_STATS: Dict[str, Any] = {
+    "runs": 0, "deleted_total": 0, "last_deleted": 0, "last_archived": 0,
+    "last_batches": 0, "last_freed_bytes": 0, "last_duration_s": 0.0,
+}
+
+
+def _cleanup_batch(c, cutoff: str) -> tuple:
+    """Одна порція: блокує до CLEANUP_BATCH старих Д/З, архівує (за потреби) і видаляє їх."""
+    with c.transaction():
+        ids = [r["id"] for r in c.execute("""
+            SELECT id FROM homework WHERE due_date < %s
+            ORDER BY due_date, id LIMIT %s FOR UPDATE SKIP LOCKED
+        """, (cutoff, CLEANUP_BATCH)).fetchall()]
+        if not ids:
+            return [], [], 0, set()
+        archived = 0
+        if CLEANUP_ARCHIVE:
+            archived = c.execute("""
+                INSERT INTO homework_archive(id, diary_id, subject, description, due_date, author_id,
+                                             author_name, is_important, created_at, attachments)
+                SELECT h.id, h.diary_id, h.subject, h.description, h.due_date, h.author_id,
+                       h.author_name, h.is_important, h.created_at,
+                       COALESCE(jsonb_agg(jsonb_build_object(
+                           'name', a.original_name, 'stored_name', a.stored_name,
+                           'mime', a.mime_type, 'size', a.size_bytes
+                       )) FILTER (WHERE a.id IS NOT NULL), '[]')
+                FROM homework h LEFT JOIN attachments a ON a.hw_id = h.id
+                WHERE h.id = ANY(%s)
+                GROUP BY h.id
+                ON CONFLICT (id) DO NOTHING
+            """, (ids,)).rowcount
+        names = [r["stored_name"] for r in c.execute(
+            "DELETE FROM attachments WHERE hw_id = ANY(%s) RETURNING stored_name", (ids,)).fetchall()]
+        diaries = {r["diary_id"] for r in c.execute(
+            "DELETE FROM homework WHERE id = ANY(%s) RETURNING diary_id", (ids,)).fetchall()}
+    return ids, names, archived, diaries
+
+
 def hw_cleanup():
+    """Видаляє Д/З, старші за 3 дні, порціями по CLEANUP_BATCH — без довгих блокувань навіть після простою."""
     cutoff = (today_kyiv() - timedelta(days=3)).isoformat()
+    t0 = monotonic()
+    deleted = archived = batches = freed = 0
+    touched = set()
     with dbc() as c:
-        return c.execute("DELETE FROM homework WHERE due_date < %s", (cutoff,)).rowcount
+        while True:
+            ids, names, n_archived, diaries = _cleanup_batch(c, cutoff)
+            if not ids:
+                break
+            archived += n_archived
+            touched |= diaries
+            # Файли звільняються вже після коміту порції: блоби, спільні з живими Д/З, лишаються
+            freed += release_blobs(c, names)
+            deleted += len(ids)
+            batches += 1
+            if batches % 10 == 0:
+                log.info("🧹 Автоочищення: %d Д/З видалено (%d порцій)…", deleted, batches)
+    for diary_id in touched:
+        hw_bulk_changed(diary_id)
+
+    _CLEANUP_STATS["runs"] += 1
+    _CLEANUP_STATS["deleted_total"] += deleted
+    _CLEANUP_STATS.update({
+        "last_deleted": deleted, "last_archived": archived, "last_batches": batches,
+        "last_freed_bytes": freed, "last_duration_s": round(monotonic() - t0, 3),
+    })
+    return deleted
 
 def sub_get(chat_id):
     with dbc() as c:
@@ -438,170 +1199,871 @@ def sub_all():
     with dbc() as c:
         return c.execute("SELECT chat_id FROM subscribers WHERE enabled=1").fetchall()
 
-def _attachments_for_hw_ids(ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
-    if not ids:
-        return {}
-    with dbc() as c:
-        rows = c.execute(
-            """
-            SELECT id, hw_id, original_name, stored_name, mime_type, size_bytes
-            FROM attachments
-            WHERE hw_id = ANY(%s)
-            ORDER BY id
-            """,
-            (ids,)
-        ).fetchall()
+def _format_attachment(a: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": int(a["id"]),
+        "name": a["name"],
+        "url": f"/files/{a['stored_name']}",
+        "mime": a.get("mime") or "",
+        "size": int(a.get("size") or 0),
+        "thumb": f"/files/{a['thumb']}" if a.get("thumb") else None,
+    }
 
-    out: Dict[int, List[Dict[str, Any]]] = {}
-    for r in rows:
-        hw_id = int(r["hw_id"])
-        out.setdefault(hw_id, []).append({
-            "id": int(r["id"]),
-            "name": r["original_name"],
-            "url": f"/files/{r['stored_name']}",
-            "mime": r["mime_type"] or "",
-            "size": int(r["size_bytes"] or 0),
-        })
-    return out
 
+# Д/З разом із вкладеннями одним запитом: вкладення агрегуються в JSON-масив
+_HW_RANGE_SQL = """
+    SELECT h.id, h.diary_id, h.subject, h.description, h.due_date, h.author_name, h.author_id, h.is_important,
+           COALESCE(
+               json_agg(json_build_object(
+                   'id', a.id, 'name', a.original_name, 'stored_name', a.stored_name,
+                   'mime', a.mime_type, 'size', a.size_bytes, 'thumb', t.thumb_name
+               ) ORDER BY a.id) FILTER (WHERE a.id IS NOT NULL),
+               '[]'
+           ) AS attachments
+    FROM homework h
+    LEFT JOIN attachments a ON a.hw_id = h.id
+    LEFT JOIN blob_thumbs t ON t.stored_name = a.stored_name
+    WHERE {where}
+    GROUP BY h.id
+    ORDER BY h.due_date, h.is_important DESC, h.subject
+"""
 
-def hw_for_date_formatted(d: str, diary_id=None):
-    with dbc() as c:
-        if diary_id is None:
-            rows = c.execute("""
-                SELECT id, subject, description, due_date, author_name, author_id, is_important
-                FROM homework
-                WHERE due_date=%s AND diary_id IS NULL
-                ORDER BY is_important DESC, subject
-            """, (d,)).fetchall()
-        else:
-            rows = c.execute("""
-                SELECT id, subject, description, due_date, author_name, author_id, is_important
-                FROM homework
-                WHERE due_date=%s AND diary_id=%s
-                ORDER BY is_important DESC, subject
-            """, (d, diary_id)).fetchall()
 
-    ids = [int(r["id"]) for r in rows]
-    att_map = _attachments_for_hw_ids(ids)
+def hw_range(start: str, end: Optional[str] = None, diary_id=None) -> List[Dict[str, Any]]:
+    """Д/З щоденника з due_date у [start, end] (end=None — без верхньої межі)."""
+    where = ["h.due_date >= %s"]
+    params: list = [start]
+    if end is not None:
+        where.append("h.due_date <= %s")
+        params.append(end)
+    if diary_id is None:
+        where.append("h.diary_id IS NULL")
+    else:
+        where.append("h.diary_id = %s")
+        params.append(diary_id)
+    return _hw_rows(" AND ".join(where), params)
+
+
+def hw_get(hw_id: int) -> Optional[Dict[str, Any]]:
+    rows = _hw_rows("h.id = %s", [hw_id])
+    return rows[0] if rows else None
+
+
+def _hw_rows(where: str, params: list) -> List[Dict[str, Any]]:
+    with dbc() as c:
+        rows = c.execute(_HW_RANGE_SQL.format(where=where), params).fetchall()
 
     return [{
         "id": int(r["id"]),
+        "diary_id": r["diary_id"],
         "subject": r["subject"],
         "description": r["description"],
         "author": r["author_name"] or "—",
         "author_id": r["author_id"],
+        "date": str(r["due_date"]),
         "is_important": int(r["is_important"] or 0),
-        "attachments": att_map.get(int(r["id"]), [])
+        "attachments": [_format_attachment(a) for a in r["attachments"]],
     } for r in rows]
 
 
-def _safe_ext(filename: str) -> str:
-    _, ext = os.path.splitext(filename or "")
-    ext = (ext or "").lower().strip()
-    if len(ext) > 12:
-        return ""
-    return ext
+def hw_by_diary(d: str) -> Dict[Optional[int], List[Dict[str, Any]]]:
+    """Д/З на дату для всіх щоденників одним запитом, згруповані за diary_id."""
+    out: Dict[Optional[int], List[Dict[str, Any]]] = {}
+    for r in _hw_rows("h.due_date = %s", [d]):
+        out.setdefault(r["diary_id"], []).append(r)
+    return out
 
 
-def _delete_file_quiet(stored_name: str):
-    try:
-        path = os.path.join(UPLOAD_DIR, stored_name)
-        if os.path.exists(path):
-            os.remove(path)
-    except Exception:
-        pass
+# ── Версії Д/З по щоденниках (для ETag). Ключ None — щоденник за замовчуванням ──
+# Із NOTIFY версія живе в пам'яті процесу: 304 віддається без БД, а чужі зміни підіймають її через
+# слухача. BOOT_ID і епоха слухача (змінюється після перепідключення, коли NOTIFY могли загубитись)
+# гарантують, що старі ETag не збігуться. Без NOTIFY дізнатись про чужі зміни нізвідки — тоді
+# версія береться зі спільної таблиці hw_versions.
+BOOT_ID = secrets.token_hex(4)  # також позначає власні NOTIFY цього процесу
+_HW_VERSIONS: Dict[Optional[int], int] = {}
+_HW_VERSIONS_LOCK = threading.Lock()
+_HW_EPOCH = 0
 
+def hw_version(diary_id: Optional[int]) -> int:
+    return _HW_VERSIONS.get(diary_id, 0)
 
-# ==========================================
-# 🤖 ТЕЛЕГРАМ БОТ
-# ==========================================
-DIV = "▔▔▔▔▔▔▔▔▔▔▔▔▔▔▔"
-HEADER_MAIN  = f"📚 *Щоденник Класу*\n{DIV}\nОбери розділ:"
-HEADER_SCHED = f"📆 *Розклад уроків*\n{DIV}\nОбери день:"
+def hw_version_tag(diary_id: Optional[int]) -> str:
+    """Версія для ETag у режимі з NOTIFY — без звернення до БД."""
+    return f"{BOOT_ID}.{_HW_EPOCH}.{hw_version(diary_id)}"
 
-def kb(*rows): return InlineKeyboardMarkup(list(rows))
-def _back(cb="go_main", label="◀️  Назад"): return InlineKeyboardButton(label, callback_data=cb)
+def hw_version_db(diary_id: Optional[int]) -> int:
+    with dbc() as c:
+        row = c.execute("SELECT version FROM hw_versions WHERE diary_key=%s", (diary_id or 0,)).fetchone()
+    return int(row["version"]) if row else 0
+
+def hw_rotate_epoch():
+    global _HW_EPOCH
+    with _HW_VERSIONS_LOCK:
+        _HW_EPOCH += 1
+
+def hw_bump_local(diary_id: Optional[int]) -> int:
+    with _HW_VERSIONS_LOCK:
+        _HW_VERSIONS[diary_id] = _HW_VERSIONS.get(diary_id, 0) + 1
+        return _HW_VERSIONS[diary_id]
+
+def hw_bump_version(diary_id: Optional[int]) -> int:
+    version = hw_bump_local(diary_id)
+    if not HW_FEED_NOTIFY and DATABASE_URL:
+        try:
+            with dbc() as c:
+                c.execute("""
+                    INSERT INTO hw_versions(diary_key, version) VALUES(%s, 1)
+                    ON CONFLICT (diary_key) DO UPDATE SET version = hw_versions.version + 1
+                """, (diary_id or 0,))
+        except Exception as e:
+            log.warning("hw_bump_version error: %s", e)
+    return version
 
-def kb_main(chat_type: str):
-    if chat_type == ChatType.PRIVATE:
-        open_btn = InlineKeyboardButton(
-            "📱 Відкрити Щоденник",
-            web_app=WebAppInfo(url=WEB_APP_URL),
-        )
-    else:
-        open_btn = InlineKeyboardButton(
-            "🤖 Відкрити в боті",
-            url=(START_WEBAPP or WEB_APP_URL),
-        )
-    return kb(
-        [open_btn],
-        [InlineKeyboardButton("📆  Розклад",            callback_data="menu_schedule")],
-        [InlineKeyboardButton("🔔  Підписка",           callback_data="menu_sub")],
-        [InlineKeyboardButton("❓  Допомога",           callback_data="help")],
-        [InlineKeyboardButton("✖  Закрити меню",       callback_data="close_menu")],
-    )
 
-def kb_schedule_days(schedule: dict):
-    days = list(schedule.keys())
-    btns = [InlineKeyboardButton(d, callback_data=f"sched_{d}") for d in days]
-    rows = [[btns[i], btns[i+1]] if i+1 < len(btns) else [btns[i]] for i in range(0, len(btns), 2)]
-    rows.append([_back()])
-    return InlineKeyboardMarkup(rows)
+def hw_changed(diary_id: Optional[int], op: str, hw_id: int):
+    """Фіксує зміну Д/З: нова версія для ETag, подія SSE-підписникам і NOTIFY іншим воркерам."""
+    hw_bump_version(diary_id)
+    HW_FEED.publish_threadsafe(diary_id, _hw_feed_event(diary_id, op, hw_id))
+    feed_notify({"diary": diary_id, "op": op, "id": int(hw_id)})
 
-def kb_sub(is_sub: bool):
-    rows = [
-        [InlineKeyboardButton("👤  Приватно (цей чат)",   callback_data="sub_private")],
-        [InlineKeyboardButton("👥  В групу — інструкція", callback_data="sub_group_info")],
-    ]
-    if is_sub:
-        rows.append([InlineKeyboardButton("🚫  Скасувати підписку", callback_data="sub_cancel")])
-    rows.append([_back()])
-    return InlineKeyboardMarkup(rows)
 
-async def delete_msg(msg):
-    try:
-        await msg.delete()
-    except Exception:
-        pass
+def hw_bulk_changed(diary_id: Optional[int]):
+    """Масова зміна (напр. автоочищення): нова версія і одна подія resync замість події на кожен рядок."""
+    hw_bump_version(diary_id)
+    HW_FEED.publish_threadsafe(diary_id, {"op": "resync"})
+    feed_notify({"diary": diary_id, "op": "resync"})
 
-async def delete_private_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+
+def feed_notify(message: dict):
+    """NOTIFY іншим воркерам (власні повідомлення слухач відкидає за origin)."""
+    if not (HW_FEED_NOTIFY and DATABASE_URL):
+        return
+    payload = json.dumps({"origin": BOOT_ID, **message})
     try:
-        if update.effective_chat and update.effective_chat.type == ChatType.PRIVATE and update.message:
-            await delete_msg(update.message)
-    except Exception:
-        pass
+        with dbc() as c:
+            c.execute("SELECT pg_notify(%s, %s)", (HW_FEED_CHANNEL, payload))
+    except Exception as e:
+        log.warning("feed_notify error: %s", e)
+
+
+def _hw_feed_event(diary_id: Optional[int], op: str, hw_id: int) -> dict:
+    if op == "resync":
+        return {"op": "resync"}
+    if op != "upsert":
+        return {"op": "delete", "id": int(hw_id)}
+    # Рядок дочитуємо лише коли є кому його віддати: одна вибірка на зміну, а не на глядача.
+    # Без рядка подія лишається upsert — клієнт, що встиг підписатися, перечитає дані сам
+    if not HW_FEED.has_subscribers(diary_id):
+        return {"op": "upsert", "id": int(hw_id)}
+    task = hw_get(hw_id)
+    if not task:
+        return {"op": "delete", "id": int(hw_id)}  # рядок уже видалили
+    return {"op": "upsert", "id": int(hw_id), "task": task}
+
+
+def _insert_attachments(c, hw_id: int, attachments: list):
+    """Вставляє вкладення в межах транзакції c, тримаючи lock кожного блобу до коміту."""
+    items = [a for a in attachments if a.get("stored_name")]
+    _lock_blobs(c, [a["stored_name"] for a in items])
+    for a in items:
+        stored_name = a["stored_name"]
+        orig = a.get("name") or "file"
+        mime = a.get("mime") or ""
+        size = int(a.get("size") or 0)
+        path = primary_blob_path(stored_name)
+        # Перевірка саме тут, під lock блобу: release перейменовує файл теж під ним
+        if not path or not os.path.exists(path):
+            continue
+        c.execute("""
+            INSERT INTO attachments(hw_id, original_name, stored_name, mime_type, size_bytes)
+            VALUES(%s,%s,%s,%s,%s)
+        """, (hw_id, orig, stored_name, mime, size))
 
-async def go_main(q, ctx):
-    chat_type = q.message.chat.type
-    await q.edit_message_text(
-        HEADER_MAIN,
-        parse_mode="Markdown",
-        reply_markup=kb_main(chat_type),
-    )
 
-async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    u = update.effective_user
-    chat = update.effective_chat
-    title = chat.title if chat.type != "private" else None
-    rec = sub_get(chat.id)
-    mode = "private" if chat.type == "private" else "group"
-    if not rec:
-        sub_enable(chat.id, u.username or u.first_name, mode, title)
-    else:
-        sub_touch(chat.id, u.username or u.first_name, mode, title)
+def hw_add(subject, desc, due, author, author_id, is_important, attachments: list):
+    # Визначаємо diary_id з контексту користувача
+    user_id = int(author_id) if author_id else None
+    diary_id = get_user_diary_context(user_id)["diary_id"]
+    with dbc() as c:
+        with c.transaction():
+            cur = c.execute("""
+                INSERT INTO homework(subject, description, due_date, author_name, author_id, is_important, diary_id)
+                VALUES(%s,%s,%s,%s,%s,%s,%s) RETURNING id
+            """, (subject, desc, due, author, author_id, is_important, diary_id))
+            hw_id = cur.fetchone()["id"]
+            _insert_attachments(c, hw_id, attachments)
+    hw_changed(diary_id, "upsert", hw_id)
+    return hw_id
 
-    chat_type = chat.type
-    payload = (ctx.args[0].strip().lower() if ctx.args else "")
 
-    # ── Обробка запрошення ──────────────────────────────────────────────────
-    if payload.startswith("invite_") and chat_type == ChatType.PRIVATE:
+def hw_update(hw_id, subject, due, desc, is_important, attachments: Optional[list]):
+    released = []
+    with dbc() as c:
+        with c.transaction():
+            row = c.execute("""
+                UPDATE homework SET subject=%s, due_date=%s, description=%s, is_important=%s
+                WHERE id=%s RETURNING diary_id
+            """, (subject, due, desc, is_important, hw_id)).fetchone()
+            if not row:
+                return
+            if attachments is not None:
+                old = c.execute("DELETE FROM attachments WHERE hw_id=%s RETURNING stored_name", (hw_id,)).fetchall()
+                _insert_attachments(c, hw_id, attachments)
+                kept_names = {a.get("stored_name") for a in attachments}
+                released = [r["stored_name"] for r in old if r["stored_name"] not in kept_names]
+        release_blobs(c, released)
+    hw_changed(row["diary_id"], "upsert", hw_id)
+
+
+def hw_delete(hw_id):
+    with dbc() as c:
+        with c.transaction():
+            names = [r["stored_name"] for r in c.execute(
+                "SELECT stored_name FROM attachments WHERE hw_id=%s", (hw_id,)).fetchall()]
+            row = c.execute("DELETE FROM homework WHERE id=%s RETURNING diary_id", (hw_id,)).fetchone()
+        release_blobs(c, names)
+    if row:
+        hw_changed(row["diary_id"], "delete", hw_id)
+
+
+_EXT_RE = re.compile(r"^\.[a-z0-9]{1,11}$")
+
+def _safe_ext(filename: str) -> str:
+    _, ext = os.path.splitext(filename or "")
+    ext = (ext or "").lower().strip()
+    if not _EXT_RE.match(ext):
+        return ""
+    return ext
+
+
+# ==========================================
+# 📦 СХОВИЩЕ ВКЛАДЕНЬ (content-addressed)
+# ==========================================
+# Блоб зберігається під іменем <sha256><ext> у UPLOAD_DIR/ab/cd/ — однаковий вміст пишеться один раз.
+# Лічильник посилань — кількість рядків attachments з цим stored_name; файл видаляється,
+# коли зникає останнє посилання. Старі файли (випадкові token_hex імена) лежать у корені UPLOAD_DIR.
+BLOB_LOCK_NS = 715_002
+_BLOB_NAME_RE = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,11})?$")
+_LEGACY_NAME_RE = re.compile(r"^[0-9a-f]{32}(\.[^./\\]{1,11})?$")
+_DERIVED_SUFFIXES = (".thumb.webp", ".page1.png", ".poster.jpg")
+_DERIVED_NAME_RE = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,11})?\.(thumb\.webp|page1\.png|poster\.jpg)$")
+
+
+class FileStore:
+    """Дискові операції сховища на окремому обмеженому пулі потоків.
+
+    Повільний диск чи великий файл займає лише цей пул — не event loop і не потоки БД.
+    """
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="files")
+        self.stats = {"ops": 0, "deleted": 0, "deleted_bytes": 0, "errors": 0}
+
+    async def run(self, fn, *args, **kwargs):
+        self.stats["ops"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def discard(self, paths):
+        """Фонове видалення файлів; можна викликати з будь-якого потоку."""
+        for p in paths:
+            try:
+                self._executor.submit(self._unlink, p)
+            except RuntimeError:  # пул уже зупинено (shutdown)
+                self._unlink(p)
+
+    def _unlink(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.stats["errors"] += 1
+            log.warning("⚠️ Не вдалося видалити файл %s: %s", path, e)
+            return
+        self.stats["deleted"] += 1
+        self.stats["deleted_bytes"] += size
+
+    def shutdown(self):
+        # Дочікуємось черги видалень, щоб не лишати .trash
+        self._executor.shutdown(wait=True)
+
+
+FILES = FileStore(FILE_IO_WORKERS)
+
+
+def blob_path(stored_name: str) -> Optional[str]:
+    """Шлях до файлу вкладення; None — якщо ім'я некоректне."""
+    if _BLOB_NAME_RE.match(stored_name or "") or _DERIVED_NAME_RE.match(stored_name or ""):
+        return os.path.join(UPLOAD_DIR, stored_name[:2], stored_name[2:4], stored_name)
+    if _LEGACY_NAME_RE.match(stored_name or ""):
+        return os.path.join(UPLOAD_DIR, stored_name)
+    return None
+
+
+def primary_blob_path(stored_name: str) -> Optional[str]:
+    """Як blob_path, але лише для самих вкладень: похідні файли (прев'ю) не можна прив'язати чи звільнити."""
+    if _DERIVED_NAME_RE.match(stored_name or ""):
+        return None
+    return blob_path(stored_name)
+
+
+def blob_commit(tmp_path: str, sha256: str, ext: str) -> tuple:
+    """Переносить завантажений тимчасовий файл у сховище; повертає (stored_name, created)."""
+    stored = f"{sha256}{ext}"
+    path = blob_path(stored)
+    with dbc() as c:
+        with c.transaction():
+            # Той самий lock, що й у _release_blob: між перевіркою і utime блоб не поїде в .trash,
+            # а після коміту свіжий mtime захищає його від прибирання до прив'язки
+            _lock_blobs(c, [stored])
+            if os.path.exists(path):
+                # Такий вміст уже є — наш тимчасовий файл не потрібен
+                os.remove(tmp_path)
+                os.utime(path)
+                return stored, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            return stored, True
+
+
+def _lock_blobs(c, names):
+    # Сортування — щоб дві транзакції не чекали одна на одну
+    for name in sorted(set(names)):
+        c.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (BLOB_LOCK_NS, name))
+
+
+def _blob_is_fresh(path: str) -> bool:
+    try:
+        return datetime.now().timestamp() - os.path.getmtime(path) < UPLOAD_GRACE_MIN * 60
+    except OSError:
+        return False
+
+
+def release_blobs(c, names) -> int:
+    """Видаляє блоби, на які більше не посилається жоден рядок attachments. Повертає звільнені байти."""
+    return sum(_release_blob(c, name) or 0 for name in set(names))
+
+
+def _release_blob(c, name: str) -> Optional[int]:
+    """Звільняє один блоб; None — якщо він ще потрібен.
+
+    Під lock блоб лише перейменовується в .trash (операція з метаданими, миттєва), тож
+    паралельний _insert_attachments його вже не побачить; саме видалення — у пулі FILES.
+    """
+    path = primary_blob_path(name)
+    if not path:
+        return None
+    with c.transaction():
+        _lock_blobs(c, [name])
+        if c.execute("SELECT 1 FROM attachments WHERE stored_name=%s LIMIT 1", (name,)).fetchone():
+            return None
+        if _blob_is_fresh(path):
+            return None  # щойно завантажений дублікат — ще може бути прив'язаний
+        trash, size = _trash_file(path)
+        c.execute("DELETE FROM blob_thumbs WHERE stored_name=%s", (name,))
+    extras = [path + suffix for suffix in (*_PRECOMPRESSED, *_DERIVED_SUFFIXES)]
+    FILES.discard(([trash] if trash else []) + extras)
+    return size
+
+
+def _trash_file(path: str) -> tuple:
+    try:
+        size = os.path.getsize(path)
+        trash = f"{path}.{secrets.token_hex(4)}.trash"
+        os.rename(path, trash)
+        return trash, size
+    except OSError:
+        return None, 0
+
+
+# ── Стиснуті копії текстових вкладень (.gz/.br поруч із блобом) ──
+_TEXT_EXTS = {".txt", ".csv", ".json", ".md", ".html", ".htm", ".xml", ".svg", ".js", ".css", ".rtf"}
+_PRECOMPRESSED = {".br": "br", ".gz": "gzip"}  # порядок = пріоритет
+PRECOMPRESS_MIN_BYTES = 1024
+
+
+def precompress_blob(path: str):
+    """Пише .gz (і .br, якщо є brotli) поруч із текстовим блобом, якщо це дає виграш."""
+    if os.path.splitext(path)[1] not in _TEXT_EXTS or os.path.getsize(path) < PRECOMPRESS_MIN_BYTES:
+        return
+    with open(path, "rb") as f:
+        data = f.read()
+    variants = {".gz": gzip.compress(data, 9)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data)
+    for enc_ext, body in variants.items():
+        if len(body) < len(data) * 0.9:
+            tmp = f"{path}{enc_ext}.part"
+            with open(tmp, "wb") as out:
+                out.write(body)
+            os.replace(tmp, path + enc_ext)
+
+
+# ── Прев'ю: WebP для зображень, PNG першої сторінки PDF, кадр-постер відео ──
+# Генерація важка для CPU, тож іде в окремих процесах; кожен формат — лише якщо є відповідна бібліотека/ffmpeg.
+_IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+_VIDEO_EXTS = {".mp4", ".mov", ".m4v", ".webm", ".mkv", ".avi", ".3gp"}
+_THUMB_POOL: Optional[ProcessPoolExecutor] = None
+_THUMB_STATS = {"done": 0, "skipped": 0, "failed": 0}
+# Pillow/PyMuPDF/brotli — у requirements.txt; ffmpeg — системний пакет (apt install ffmpeg)
+THUMB_BACKENDS = {"image": Image is not None, "pdf": fitz is not None, "video": bool(shutil.which("ffmpeg"))}
+
+
+def _thumb_kind(stored_name: str) -> Optional[str]:
+    ext = os.path.splitext(stored_name)[1]
+    if ext in _IMAGE_EXTS and Image is not None:
+        return "image"
+    if ext == ".pdf" and fitz is not None:
+        return "pdf"
+    if ext in _VIDEO_EXTS and shutil.which("ffmpeg"):
+        return "video"
+    return None
+
+
+def build_thumbnail(path: str, kind: str, size: int) -> Optional[str]:
+    """Виконується в процесі пулу. Повертає суфікс створеного прев'ю або None."""
+    if kind == "image":
+        suffix = ".thumb.webp"
+        tmp = path + suffix + ".part"
+        with Image.open(path) as im:
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((size, size))
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+            im.save(tmp, "WEBP", quality=75, method=4)
+    elif kind == "pdf":
+        suffix = ".page1.png"
+        tmp = path + suffix + ".part"
+        with fitz.open(path) as doc:
+            page = doc[0]
+            zoom = size / max(page.rect.width, page.rect.height)
+            page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).save(tmp, output="png")
+    elif kind == "video":
+        suffix = ".poster.jpg"
+        tmp = path + suffix + ".part"
+        for seek in ("1", "0"):  # коротке відео може не мати кадру на 1-й секунді
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-y", "-ss", seek, "-i", path, "-frames:v", "1",
+                 "-vf", f"scale='min({size},iw)':-2", "-f", "image2", tmp],
+                check=False, timeout=60, stdin=subprocess.DEVNULL,
+            )
+            if os.path.exists(tmp) and os.path.getsize(tmp) > 0:
+                break
+        else:
+            return None
+    else:
+        return None
+    os.replace(tmp, path + suffix)
+    return suffix
+
+
+def _thumb_pool() -> ProcessPoolExecutor:
+    global _THUMB_POOL
+    if _THUMB_POOL is None:
+        # spawn: дочірній процес не успадковує потоки/з'єднання батька
+        _THUMB_POOL = ProcessPoolExecutor(max_workers=THUMB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _THUMB_POOL
+
+
+def close_thumb_pool():
+    global _THUMB_POOL
+    if _THUMB_POOL is not None:
+        _THUMB_POOL.shutdown(wait=False, cancel_futures=True)
+        _THUMB_POOL = None
+
+
+def thumb_record(stored_name: str, thumb_name: str):
+    """Зберігає прев'ю блобу і сповіщає про зміну Д/З, які вже на нього посилаються."""
+    with dbc() as c:
+        c.execute("""
+            INSERT INTO blob_thumbs(stored_name, thumb_name) VALUES(%s,%s)
+            ON CONFLICT (stored_name) DO UPDATE SET thumb_name=EXCLUDED.thumb_name
+        """, (stored_name, thumb_name))
+        rows = c.execute("""
+            SELECT DISTINCT h.id, h.diary_id FROM attachments a JOIN homework h ON h.id = a.hw_id
+            WHERE a.stored_name=%s
+        """, (stored_name,)).fetchall()
+    for r in rows:
+        hw_changed(r["diary_id"], "upsert", r["id"])
+
+
+async def generate_thumbnail(stored_name: str):
+    kind = _thumb_kind(stored_name) if THUMB_WORKERS > 0 else None
+    if not kind:
+        _THUMB_STATS["skipped"] += 1
+        return
+    path = blob_path(stored_name)
+    try:
+        suffix = await asyncio.get_running_loop().run_in_executor(
+            _thumb_pool(), build_thumbnail, path, kind, THUMB_SIZE)
+    except Exception as e:
+        _THUMB_STATS["failed"] += 1
+        log.warning("⚠️ Прев'ю для %s не створено: %s", stored_name, e)
+        return
+    if not suffix:
+        _THUMB_STATS["failed"] += 1
+        return
+    _THUMB_STATS["done"] += 1
+    if DATABASE_URL:
+        await run_db(thumb_record, stored_name, stored_name + suffix)
+
+
+# ── Прибирання сховища: файли без посилань в attachments ──
+# Інкрементально: кожен запуск обходить GC_SHARDS_PER_RUN каталогів верхнього рівня (00..ff),
+# курсор продовжує з того ж місця; позиція 0 — корінь UPLOAD_DIR зі старими плоскими файлами.
+_GC_SHARDS = [""] + [f"{i:02x}" for i in range(256)]
+_GC_STATE = {"cursor": 0, "cycle_files": 0, "cycle_bytes": 0}
+_GC_STATS: Dict[str, Any] = {
+    "runs": 0, "cycles": 0, "deleted": 0, "reclaimed_bytes": 0, "stale_parts": 0,
+    "last_run_s": 0.0, "disk_files": None, "disk_bytes": None, "usage": None,
+}
+
+
+def _gc_shard_files(shard: str) -> List[tuple]:
+    """(ім'я, шлях, розмір, mtime) усіх файлів каталогу шарду."""
+    top = os.path.join(UPLOAD_DIR, shard)
+    if shard:
+        dirs = [os.path.join(top, d) for d in sorted(os.listdir(top))] if os.path.isdir(top) else []
+    else:
+        dirs = [top]
+    out = []
+    for d in dirs:
+        try:
+            entries = list(os.scandir(d))
+        except OSError:
+            continue
+        for e in entries:
+            if e.is_file(follow_symlinks=False):
+                st = e.stat()
+                out.append((e.name, e.path, st.st_size, st.st_mtime))
+    return out
+
+
+def _gc_base_name(name: str) -> Optional[str]:
+    """Ім'я блобу, якому належить похідний файл (.gz/.br/прев'ю); для самого блобу — воно ж."""
+    for suffix in (*_PRECOMPRESSED, *_DERIVED_SUFFIXES):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _gc_scan(shards: List[str], cutoff: float) -> Dict[str, Any]:
+    """Дискова частина кроку (пул FILES): обхід шардів, прибирання залишків без звернень до БД."""
+    files = size_total = stale = 0
+    blobs: Dict[str, float] = {}
+    junk: List[str] = []
+    derived: List[tuple] = []
+    for shard in shards:
+        for name, path, size, mtime in _gc_shard_files(shard):
+            files += 1
+            size_total += size
+            if name.endswith(".trash") or (name.endswith(".part") and mtime < cutoff):
+                # Недовидалений блоб / обірваний upload чи генерація прев'ю
+                junk.append(path)
+                stale += 1
+                continue
+            base = _gc_base_name(name)
+            if name.endswith(".part") or not blob_path(base):
+                continue  # чуже ім'я — не чіпаємо
+            if base == name:
+                blobs[name] = mtime
+            else:
+                derived.append((base, path, mtime))
+    # Похідні файли (.gz/.br/прев'ю), чий блоб уже зник, — у тому ж каталозі, тож скану досить
+    junk.extend(path for base, path, mtime in derived if base not in blobs and mtime < cutoff)
+    FILES.discard(junk)
+    return {
+        "files": files, "bytes": size_total, "stale": stale, "junk": len(junk),
+        "names": [n for n, mtime in blobs.items() if mtime < cutoff],
+    }
+
+
+def _gc_reconcile(names: List[str]) -> tuple:
+    """БД-частина кроку: звіряє імена з attachments і звільняє блоби без посилань."""
+    deleted = freed = 0
+    with dbc() as c:
+        for i in range(0, len(names), GC_BATCH):
+            chunk = names[i:i + GC_BATCH]
+            used = {r["stored_name"] for r in c.execute(
+                "SELECT DISTINCT stored_name FROM attachments WHERE stored_name = ANY(%s)", (chunk,)).fetchall()}
+            # _release_blob ще раз перевіряє посилання під lock — паралельний hw_add не постраждає
+            for name in chunk:
+                if name in used:
+                    continue
+                size = _release_blob(c, name)
+                if size is not None:
+                    deleted += 1
+                    freed += size
+        usage = None
+        if _GC_STATE["cursor"] == 0:
+            usage = storage_usage(c)
+    return deleted, freed, usage
+
+
+async def gc_storage_step() -> Dict[str, Any]:
+    """Один інкрементальний крок прибирання. Повертає підсумок кроку."""
+    t0 = monotonic()
+    cutoff = datetime.now().timestamp() - UPLOAD_GRACE_MIN * 60
+    shards = [_GC_SHARDS[(_GC_STATE["cursor"] + i) % len(_GC_SHARDS)]
+              for i in range(min(GC_SHARDS_PER_RUN, len(_GC_SHARDS)))]
+    scan = await FILES.run(_gc_scan, shards, cutoff)
+    _GC_STATE["cycle_files"] += scan["files"]
+    _GC_STATE["cycle_bytes"] += scan["bytes"]
+    _GC_STATE["cursor"] = (_GC_STATE["cursor"] + len(shards)) % len(_GC_SHARDS)
+
+    # Після повного обходу (курсор повернувся на 0) заодно рахуємо використання по щоденниках
+    deleted, freed, usage = await run_db(_gc_reconcile, scan["names"])
+    if usage is not None:
+        _GC_STATS["cycles"] += 1
+        _GC_STATS["disk_files"] = _GC_STATE["cycle_files"]
+        _GC_STATS["disk_bytes"] = _GC_STATE["cycle_bytes"]
+        _GC_STATE["cycle_files"] = _GC_STATE["cycle_bytes"] = 0
+        _GC_STATS["usage"] = usage
+
+    _GC_STATS["runs"] += 1
+    _GC_STATS["deleted"] += deleted
+    _GC_STATS["reclaimed_bytes"] += freed
+    _GC_STATS["stale_parts"] += scan["stale"]
+    _GC_STATS["last_run_s"] = round(monotonic() - t0, 3)
+    return {"shards": len(shards), "files": scan["files"], "deleted": deleted + scan["junk"], "freed": freed}
+
+
+def storage_usage(c) -> List[Dict[str, Any]]:
+    """Файли/байти вкладень по щоденниках (блоб, спільний для кількох Д/З щоденника, рахується раз).
+
+    Лише id щоденників — назви в метриках не публікуємо.
+    """
+    rows = c.execute("""
+        SELECT u.diary_id, COUNT(*) AS files, COALESCE(SUM(u.size_bytes), 0) AS bytes
+        FROM (
+            SELECT DISTINCT h.diary_id, a.stored_name, a.size_bytes
+            FROM attachments a JOIN homework h ON h.id = a.hw_id
+        ) u
+        GROUP BY u.diary_id
+        ORDER BY bytes DESC
+    """).fetchall()
+    return [{"diary_id": r["diary_id"], "files": int(r["files"]), "bytes": int(r["bytes"])} for r in rows]
+
+
+# ==========================================
+# 📡 СТРІЧКА ЗМІН Д/З (SSE + LISTEN/NOTIFY)
+# ==========================================
+class HwFeed:
+    """Розсилає зміни Д/З відкритим Mini App по щоденниках замість 10-секундного опитування."""
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subs: Dict[Optional[int], set] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"events": 0, "delivered": 0, "overflows": 0, "remote": 0, "resyncs": 0}
+
+    def has_subscribers(self, diary_id: Optional[int]) -> bool:
+        return bool(self._subs.get(diary_id))
+
+    def subscribe(self, diary_id: Optional[int]) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=HW_FEED_QUEUE_SIZE)
+        self._subs.setdefault(diary_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, diary_id: Optional[int], q: asyncio.Queue):
+        subs = self._subs.get(diary_id)
+        if subs is not None:
+            subs.discard(q)
+            if not subs:
+                self._subs.pop(diary_id, None)
+
+    def publish(self, diary_id: Optional[int], event: dict):
+        self.stats["events"] += 1
+        for q in list(self._subs.get(diary_id, ())):
+            try:
+                q.put_nowait(event)
+                self.stats["delivered"] += 1
+            except asyncio.QueueFull:
+                # Клієнт не встигає — скидаємо чергу і просимо повне перезавантаження
+                self.stats["overflows"] += 1
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait({"op": "resync"})
+
+    def publish_threadsafe(self, diary_id: Optional[int], event: dict):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.publish, diary_id, event)
+
+    def subscriber_count(self) -> int:
+        return sum(len(v) for v in self._subs.values())
+
+    # ── LISTEN/NOTIFY: зміни з інших воркерів ────────────────────────────────
+    def start_listener(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        if not (DATABASE_URL and HW_FEED_NOTIFY):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen, name="hw-feed-listen", daemon=True)
+        self._thread.start()
+
+    def stop_listener(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _listen(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {HW_FEED_CHANNEL}")
+                backoff = 1.0
+                # Поки слухача не було, NOTIFY могли загубитися — скидаємо все, що від них залежить
+                asyncio.run_coroutine_threadsafe(self._resync_all(), self.loop)
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            n = conn.notifies.pop(0)
+                            asyncio.run_coroutine_threadsafe(self._on_remote(n.payload), self.loop)
+            except Exception as e:
+                log.warning("hw feed listener error: %s", e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    async def _resync_all(self):
+        self.stats["resyncs"] += 1
+        hw_rotate_epoch()  # усі видані до цього ETag більше не збігаються
+        _CTX_CACHE.clear()
+        for diary_id in list(self._subs):
+            self.publish(diary_id, {"op": "resync"})
+        try:
+            await run_db(SCHEDULE_REGISTRY.refresh_if_stale)
+        except Exception as e:
+            log.warning("schedules reload error: %s", e)
+
+    async def _on_remote(self, payload: str):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if data.get("origin") == BOOT_ID:
+            return
+        self.stats["remote"] += 1
+        if data.get("op") == "ctx":
+            _CTX_CACHE.invalidate(int(data.get("user") or 0))
+            return
+        if data.get("op") == "schedules":
+            try:
+                await run_db(SCHEDULE_REGISTRY.load)
+            except Exception as e:
+                log.warning("schedules reload error: %s", e)
+            return
+        diary_id = data.get("diary")
+        hw_bump_local(diary_id)  # NOTIFY є — спільну таблицю версій не чіпаємо
+        try:
+            event = await run_db(_hw_feed_event, diary_id, data.get("op"), data.get("id"))
+        except Exception as e:
+            log.warning("hw feed remote event error: %s", e)
+            event = {"op": "resync"}
+        self.publish(diary_id, event)
+
+
+HW_FEED = HwFeed()
+
+
+# ==========================================
+# 🤖 ТЕЛЕГРАМ БОТ
+# ==========================================
+DIV = "▔▔▔▔▔▔▔▔▔▔▔▔▔▔▔"
+HEADER_MAIN  = f"📚 *Щоденник Класу*\n{DIV}\nОбери розділ:"
+HEADER_SCHED = f"📆 *Розклад уроків*\n{DIV}\nОбери день:"
+
+def kb(*rows): return InlineKeyboardMarkup(list(rows))
+def _back(cb="go_main", label="◀️  Назад"): return InlineKeyboardButton(label, callback_data=cb)
+
+def kb_main(chat_type: str):
+    if chat_type == ChatType.PRIVATE:
+        open_btn = InlineKeyboardButton(
+            "📱 Відкрити Щоденник",
+            web_app=WebAppInfo(url=webapp_url()),
+        )
+    else:
+        open_btn = InlineKeyboardButton(
+            "🤖 Відкрити в боті",
+            url=(START_WEBAPP or WEB_APP_URL),
+        )
+    return kb(
+        [open_btn],
+        [InlineKeyboardButton("📆  Розклад",            callback_data="menu_schedule")],
+        [InlineKeyboardButton("🔔  Підписка",           callback_data="menu_sub")],
+        [InlineKeyboardButton("❓  Допомога",           callback_data="help")],
+        [InlineKeyboardButton("✖  Закрити меню",       callback_data="close_menu")],
+    )
+
+def kb_schedule_days(schedule: dict):
+    days = list(schedule.keys())
+    btns = [InlineKeyboardButton(d, callback_data=f"sched_{d}") for d in days]
+    rows = [[btns[i], btns[i+1]] if i+1 < len(btns) else [btns[i]] for i in range(0, len(btns), 2)]
+    rows.append([_back()])
+    return InlineKeyboardMarkup(rows)
+
+def kb_sub(is_sub: bool):
+    rows = [
+        [InlineKeyboardButton("👤  Приватно (цей чат)",   callback_data="sub_private")],
+        [InlineKeyboardButton("👥  В групу — інструкція", callback_data="sub_group_info")],
+    ]
+    if is_sub:
+        rows.append([InlineKeyboardButton("🚫  Скасувати підписку", callback_data="sub_cancel")])
+    rows.append([_back()])
+    return InlineKeyboardMarkup(rows)
+
+async def delete_msg(msg):
+    try:
+        await msg.delete()
+    except Exception:
+        pass
+
+async def delete_private_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_chat and update.effective_chat.type == ChatType.PRIVATE and update.message:
+            await delete_msg(update.message)
+    except Exception:
+        pass
+
+async def go_main(q, ctx):
+    chat_type = q.message.chat.type
+    await q.edit_message_text(
+        HEADER_MAIN,
+        parse_mode="Markdown",
+        reply_markup=kb_main(chat_type),
+    )
+
+async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    chat = update.effective_chat
+    title = chat.title if chat.type != "private" else None
+    rec = await run_db(sub_get, chat.id)
+    mode = "private" if chat.type == "private" else "group"
+    if not rec:
+        await run_db(sub_enable, chat.id, u.username or u.first_name, mode, title)
+    else:
+        await run_db(sub_touch, chat.id, u.username or u.first_name, mode, title)
+
+    chat_type = chat.type
+    payload = (ctx.args[0].strip().lower() if ctx.args else "")
+
+    # ── Обробка запрошення ──────────────────────────────────────────────────
+    if payload.startswith("invite_") and chat_type == ChatType.PRIVATE:
         code = ctx.args[0].strip()[7:]  # original case
-        diary_id = use_diary_invite(code, u.id)
+        diary_id = await run_db(use_diary_invite, code, u.id)
         if diary_id is not None:
             try:
-                with dbc() as c:
-                    diary = c.execute("SELECT name FROM diaries WHERE id=%s", (diary_id,)).fetchone()
+                diary = await run_db(diary_get, diary_id)
                 diary_name = diary["name"] if diary else "Щоденник"
             except Exception:
                 diary_name = "Щоденник"
@@ -645,8 +2107,8 @@ async def cmd_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_schedule(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id if update.effective_user else None
-    diary_ctx = get_user_diary_context(user_id)
-    schedule = SCHEDULES.get(diary_ctx["schedule_key"], SCHEDULE_11)
+    diary_ctx = await run_db(get_user_diary_context, user_id)
+    schedule = schedule_days(diary_ctx["schedule_key"])
     await update.message.reply_text(
         HEADER_SCHED, parse_mode="Markdown",
         reply_markup=kb_schedule_days(schedule)
@@ -670,8 +2132,8 @@ async def cb_menu_schedule(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     user_id = update.effective_user.id if update.effective_user else None
-    diary_ctx = get_user_diary_context(user_id)
-    schedule = SCHEDULES.get(diary_ctx["schedule_key"], SCHEDULE_11)
+    diary_ctx = await run_db(get_user_diary_context, user_id)
+    schedule = schedule_days(diary_ctx["schedule_key"])
     await q.edit_message_text(
         HEADER_SCHED, parse_mode="Markdown",
         reply_markup=kb_schedule_days(schedule)
@@ -681,21 +2143,10 @@ async def cb_sched_day(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     user_id = update.effective_user.id if update.effective_user else None
-    diary_ctx = get_user_diary_context(user_id)
-    schedule = SCHEDULES.get(diary_ctx["schedule_key"], SCHEDULE_11)
+    diary_ctx = await run_db(get_user_diary_context, user_id)
 
     day = q.data.replace("sched_", "")
-    subjects = schedule.get(day, [])
-    text = f"📆 *{day}*\n{DIV}\n\n"
-    lesson_num = 0
-    for num, start, end in BELLS:
-        if num == 0:
-            text += f"\n╭─ 🍽  *Обідня перерва*\n╰─ {start} – {end}\n\n"
-        else:
-            lesson_num += 1
-            if lesson_num - 1 < len(subjects):
-                subj = subjects[lesson_num - 1]
-                text += f"╭─ *{num}.* {ei(subj)} {subj}\n╰─ {start} – {end}\n"
+    text = f"📆 *{day}*\n{DIV}\n\n" + render_day(diary_ctx["schedule_key"], day, today_kyiv())
 
     await q.edit_message_text(
         text, parse_mode="Markdown",
@@ -705,7 +2156,7 @@ async def cb_sched_day(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cb_menu_sub(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    rec = sub_get(update.effective_chat.id)
+    rec = await run_db(sub_get, update.effective_chat.id)
     is_active = bool(rec and int(rec.get("enabled", 1)) == 1)
     status = (
         f"✅ *Активна* — {'в групу 👥' if rec and rec.get('mode')=='group' else 'приватно 👤'}"
@@ -721,7 +2172,7 @@ async def cb_sub_private(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     if update.effective_chat.type != "private":
         return await q.answer("⚠️ Тільки в приватному чаті!", show_alert=True)
-    sub_enable(update.effective_chat.id, update.effective_user.first_name, "private")
+    await run_db(sub_enable, update.effective_chat.id, update.effective_user.first_name, "private")
     await q.edit_message_text(
         f"✅ *Підписку оформлено!*\n{DIV}\n\n👤 Нагадування щодня о *08:00*.",
         parse_mode="Markdown", reply_markup=kb([_back()])
@@ -738,7 +2189,7 @@ async def cb_sub_group_info(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cb_sub_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    sub_disable(update.effective_chat.id)
+    await run_db(sub_disable, update.effective_chat.id)
     await q.edit_message_text(
         f"🚫 *Підписку скасовано*\n{DIV}\n\nРанкові нагадування вимкнено.",
         parse_mode="Markdown", reply_markup=kb([_back()])
@@ -759,106 +2210,354 @@ async def cb_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown", reply_markup=kb([_back()])
     )
 
-async def _broadcast(bot, text: str, chat_ids=None):
-    if chat_ids is None:
-        targets = sub_all()
-        chat_ids = [r["chat_id"] for r in targets]
-    for cid in chat_ids:
-        try:
-            await bot.send_message(cid, text, parse_mode="Markdown")
-        except Exception as ex:
-            log.warning("Broadcast failed %s: %s", cid, ex)
-
-
-def _get_diary_subscriber_ids(diary_id: Optional[int]) -> List[int]:
-    """Повертає chat_id підписників для конкретного щоденника."""
-    if diary_id is None:
-        # Усі підписники, яких немає в жодному custom diary
-        try:
-            with dbc() as c:
-                members_in_custom = set(
-                    r["user_id"] for r in c.execute(
-                        "SELECT user_id FROM diary_members"
-                    ).fetchall()
-                )
-                rows = c.execute(
-                    "SELECT chat_id FROM subscribers WHERE enabled=1"
-                ).fetchall()
-            return [r["chat_id"] for r in rows if r["chat_id"] not in members_in_custom]
-        except Exception:
-            return []
-    else:
-        try:
-            with dbc() as c:
-                members = c.execute(
-                    "SELECT user_id FROM diary_members WHERE diary_id=%s", (diary_id,)
-                ).fetchall()
-                member_ids = [r["user_id"] for r in members]
-                if not member_ids:
-                    return []
-                rows = c.execute(
-                    "SELECT chat_id FROM subscribers WHERE enabled=1 AND chat_id = ANY(%s)",
-                    (member_ids,)
-                ).fetchall()
-            return [r["chat_id"] for r in rows]
-        except Exception:
-            return []
+class RateLimiter:
+    """Глобальний token bucket для всіх відправок бота; RetryAfter ставить його на паузу."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._stamp = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """Паралельна розсилка з лімітами Telegram, повторами та звітом про кожен прогін."""
+
+    def __init__(self, concurrency: int, rate: float, retries: int):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.limiter = RateLimiter(rate)
+        self._chat_next: Dict[int, float] = {}
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self.last_report: Optional[dict] = None
+        self.totals = {"runs": 0, "sent": 0, "failed": 0, "blocked": 0, "retries": 0}
+
+    async def _chat_turn(self, chat_id: int):
+        """Витримує мінімальний інтервал між повідомленнями в один чат."""
+        wait = self._chat_next.get(chat_id, 0.0) - monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        interval = BROADCAST_GROUP_INTERVAL if chat_id < 0 else BROADCAST_PRIVATE_INTERVAL
+        self._chat_next[chat_id] = monotonic() + interval
+
+    async def _send_one(self, bot, chat_id: int, text: str, latencies: list) -> str:
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.totals["retries"] += 1
+                await self._chat_turn(chat_id)
+                await self.limiter.acquire()
+                t0 = monotonic()
+                try:
+                    await bot.send_message(chat_id, text, parse_mode="Markdown")
+                    latencies.append(monotonic() - t0)
+                    return "sent"
+                except RetryAfter as ex:
+                    ra = ex.retry_after
+                    self.limiter.pause(ra.total_seconds() if isinstance(ra, timedelta) else float(ra))
+                except ChatMigrated as ex:
+                    log.warning("Broadcast: chat %s migrated to %s", chat_id, ex.new_chat_id)
+                    chat_id = ex.new_chat_id
+                except Forbidden as ex:
+                    log.info("Broadcast: chat %s blocked the bot: %s", chat_id, ex)
+                    return "blocked"
+                except BadRequest as ex:
+                    if "chat not found" in str(ex).lower():
+                        return "blocked"
+                    log.warning("Broadcast failed %s: %s", chat_id, ex)
+                    return "failed"
+                except NetworkError as ex:
+                    log.warning("Broadcast retry %s (%d): %s", chat_id, attempt + 1, ex)
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                except Exception as ex:
+                    log.warning("Broadcast failed %s: %s", chat_id, ex)
+                    return "failed"
+            return "failed"
+
+    async def send_all(self, bot, items: List[tuple]) -> dict:
+        """items — (key, chat_id, text). Повертає звіт з outcomes[key] = sent|failed|blocked."""
+        sem = asyncio.Semaphore(self.concurrency)
+        outcomes: Dict[Any, str] = {}
+        latencies: List[float] = []
+        t0 = monotonic()
+
+        async def one(key, chat_id, text):
+            async with sem:
+                outcomes[key] = await self._send_one(bot, chat_id, text, latencies)
+
+        await asyncio.gather(*(one(*it) for it in items))
+
+        blocked = {cid for key, cid, _ in items if outcomes.get(key) == "blocked"}
+        for cid in blocked:
+            try:
+                await run_db(sub_disable, cid)
+            except Exception as ex:
+                log.warning("Broadcast: sub_disable %s failed: %s", cid, ex)
+
+        # Прибираємо застарілі записи інтервалів, щоб словник не ріс безмежно
+        now = monotonic()
+        for cid in [c for c, t in self._chat_next.items() if t < now]:
+            self._chat_next.pop(cid, None)
+            lock = self._chat_locks.get(cid)
+            if lock is not None and not lock.locked():
+                self._chat_locks.pop(cid, None)
+
+        duration = monotonic() - t0
+        counts = {k: sum(1 for v in outcomes.values() if v == k) for k in ("sent", "failed", "blocked")}
+        lat = sorted(latencies)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 1) if lat else 0.0
+        report = {
+            "total": len(items), **counts,
+            "duration_s": round(duration, 3),
+            "throughput_per_s": round(counts["sent"] / duration, 2) if duration > 0 else 0.0,
+            "latency_p50_ms": pct(0.50), "latency_p95_ms": pct(0.95), "latency_max_ms": pct(1.0),
+            "outcomes": outcomes,
+        }
+        self.totals["runs"] += 1
+        for k in counts:
+            self.totals[k] += counts[k]
+        self.last_report = {k: v for k, v in report.items() if k != "outcomes"}
+        if items:
+            log.info("📨 Розсилка: %d/%d за %.1f с (%.1f/с), blocked=%d failed=%d",
+                     counts["sent"], len(items), duration, report["throughput_per_s"],
+                     counts["blocked"], counts["failed"])
+        return report
+
+
+BROADCAST = BroadcastEngine(BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_RETRIES)
+
+
+def subscribers_by_diary() -> Dict[Optional[int], List[int]]:
+    """Отримувачі всіх щоденників одним запитом; ключ None — підписники поза кастомними щоденниками."""
+    with dbc() as c:
+        rows = c.execute("""
+            SELECT dm.diary_id, array_agg(s.chat_id ORDER BY s.chat_id) AS chat_ids
+            FROM subscribers s
+            LEFT JOIN diary_members dm ON dm.user_id = s.chat_id
+            WHERE s.enabled=1
+            GROUP BY dm.diary_id
+        """).fetchall()
+    return {r["diary_id"]: list(r["chat_ids"]) for r in rows}
+
+
+def _hw_lines(rows: list, mark_important: bool = True) -> str:
+    text = ""
+    for r in rows:
+        imp  = "🔴 " if mark_important and r.get("is_important") else ""
+        clip = " 📎" if r.get("attachments") else ""
+        text += f"╭─ {imp}{ei(r['subject'])} *{r['subject']}*{clip}\n│  📋 {r['description']}\n╰─ 👤 {r['author']}\n\n"
+    return text
 
 
-def _build_morning_text(today: date, diary_id: Optional[int], schedule_key: str) -> str:
-    if schedule_key == "9":
-        schedule = get_resolved_schedule_9(today)
-    else:
-        schedule = SCHEDULES.get(schedule_key, SCHEDULE_11)
+def _build_morning_text(today: date, schedule_key: str, rows: list) -> str:
     dn = DAYS_UA[today.weekday()]
-    subjects = schedule.get(dn, [])
-    sched_lines = ""
-    lesson_idx = 0
-    for num, start, end in BELLS:
-        if num == 0:
-            sched_lines += f"   ☕ Перерва {start}–{end}\n"
-        else:
-            if lesson_idx < len(subjects):
-                s = subjects[lesson_idx]
-                sched_lines += f"╭─ *{num}.* {ei(s)} {s}\n╰─ {start}–{end}\n"
-                lesson_idx += 1
+    sched_lines = render_day(schedule_key, dn, today, "morning")
 
     text = f"☀️ *Доброго ранку!*\n📅 *{dn}, {today.strftime('%d.%m')}*\n{DIV}\n\n📆 *Розклад на сьогодні:*\n{sched_lines}\n"
-    rows = hw_for_date_formatted(today.isoformat(), diary_id=diary_id)
     if rows:
-        text += "📚 *Д/З на сьогодні:*\n"
-        for r in rows:
-            imp  = "🔴 " if r.get("is_important") else ""
-            clip = " 📎" if r.get("attachments") else ""
-            text += f"╭─ {imp}{ei(r['subject'])} *{r['subject']}*{clip}\n│  📋 {r['description']}\n╰─ 👤 {r['author']}\n\n"
+        text += "📚 *Д/З на сьогодні:*\n" + _hw_lines(rows)
     else:
         text += "📭 Д/З на сьогодні немає 🎉\n"
     return text
 
 
+def _build_evening_text(tomorrow: date, rows: list) -> Optional[str]:
+    important = [r for r in rows if r.get("is_important")]
+    if not important:
+        return None
+    dn = DAYS_UA[tomorrow.weekday()]
+    text = f"🔴 *Важливе Д/З на завтра — {dn}, {tomorrow.strftime('%d.%m')}*\n{DIV}\n\n"
+    return text + _hw_lines(important, mark_important=False)
+
+
+def _build_sunday_text(tomorrow: date, rows: list) -> str:
+    dn = DAYS_UA[tomorrow.weekday()]
+    text = f"📋 *Д/З на завтра — {dn}, {tomorrow.strftime('%d.%m')}*\n{DIV}\n\n"
+    if not rows:
+        return text + "📭 На понеділок Д/З немає 🎉\nГарного відпочинку!\n"
+    if any(r.get("is_important") for r in rows):
+        text += "⚠️ *Є важливі завдання!*\n\n"
+    return text + _hw_lines(rows)
+
+
+def _job_messages(kind: str, today: date) -> List[tuple]:
+    """(run_key, chat_ids, text) для всіх щоденників: 3 запити незалежно від кількості щоденників."""
+    target = today if kind == "morning" else today + timedelta(days=1)
+    recipients = subscribers_by_diary()
+    if not any(recipients.values()):
+        return []
+    diaries = [(None, "11")] + [(int(d["id"]), d["schedule_key"] or "9") for d in diaries_all()]
+    hw = hw_by_diary(target.isoformat())
+
+    messages = []
+    for diary_id, schedule_key in diaries:
+        chat_ids = recipients.get(diary_id)
+        if not chat_ids:
+            continue
+        rows = hw.get(diary_id, [])
+        if kind == "morning":
+            text = _build_morning_text(today, schedule_key, rows)
+        elif kind == "evening":
+            text = _build_evening_text(target, rows)
+        else:
+            text = _build_sunday_text(target, rows)
+        if text:
+            messages.append((f"{kind}:{target}:{diary_id or 0}", chat_ids, text))
+    return messages
+
+
 # ==========================================
-# ⏰ JOBS
+# 📮 OUTBOX — надійна черга розсилок
 # ==========================================
-async def job_morning(ctx: ContextTypes.DEFAULT_TYPE):
-    today = today_kyiv()
-    if today.weekday() >= 5:
+# Джоби лише кладуть (run_key, chat_id, text) у таблицю outbox, а відправляє їх outbox_drain.
+# Після рестарту незавершені рядки дочитуються, повторний запуск джоба не дублює повідомлення.
+# Відправляє лише лідер: token bucket BROADCAST_RATE живе в пам'яті процесу, і лише один
+# відправник гарантує, що бот загалом не перевищить ліміт Telegram.
+def outbox_enqueue(messages: List[tuple], ttl_hours: int = OUTBOX_TTL_HOURS) -> int:
+    """messages — (run_key, chat_ids, text). Усе вставляється одним запитом; повертає кількість нових рядків."""
+    rows = [(run_key, cid, text, ttl_hours)
+            for run_key, chat_ids, text in messages
+            for cid in dict.fromkeys(chat_ids)]
+    if not rows:
+        return 0
+    with dbc() as c:
+        # Термін рахує сам Postgres: NOW() і порівняння в outbox_claim — в одному часовому поясі сесії
+        inserted = execute_values(
+            c.conn.cursor(),
+            """INSERT INTO outbox(run_key, chat_id, text, expires_at) VALUES %s
+               ON CONFLICT (run_key, chat_id) DO NOTHING RETURNING id""",
+            rows,
+            template="(%s, %s, %s, NOW() + make_interval(hours => %s))",
+            page_size=1000,
+            fetch=True,
+        )
+    return len(inserted)
+
+
+def outbox_claim(limit: int, lease_s: int) -> list:
+    """Захоплює до limit рядків на lease_s секунд; прострочені позначає expired."""
+    with dbc() as c:
+        c.execute(
+            """UPDATE outbox SET status='expired', locked_until=NULL
+               WHERE status IN ('pending','sending') AND expires_at <= NOW()"""
+        )
+        return c.execute(
+            """
+            UPDATE outbox SET status='sending', attempts=attempts+1,
+                   locked_until=NOW() + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE (status='pending' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW()))
+                   OR (status='sending' AND locked_until < NOW())
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, text
+            """,
+            (lease_s, limit)
+        ).fetchall()
+
+
+def outbox_mark(outcomes: Dict[int, str]):
+    """Фіксує результати: sent/blocked — остаточно, failed — повтор до OUTBOX_MAX_ATTEMPTS.
+
+    Повтор відкладається експоненційно (OUTBOX_RETRY_BASE × 2^(спроба-1), не довше години),
+    щоб той самий drain не забирав рядок знову одразу після збою.
+    """
+    if not outcomes:
         return
+    with dbc() as c:
+        execute_values(
+            c.conn.cursor(),
+            """
+            UPDATE outbox o SET
+                status = CASE WHEN v.status = 'failed' AND o.attempts < %d THEN 'pending' ELSE v.status END,
+                next_attempt_at = CASE WHEN v.status = 'failed'
+                    THEN NOW() + make_interval(secs => LEAST(%d * power(2, o.attempts - 1), 3600))
+                    ELSE o.next_attempt_at END,
+                sent_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE o.sent_at END,
+                locked_until = NULL
+            FROM (VALUES %%s) AS v(id, status)
+            WHERE o.id = v.id
+            """ % (int(OUTBOX_MAX_ATTEMPTS), int(OUTBOX_RETRY_BASE)),
+            list(outcomes.items()),
+        )
+
+
+def outbox_purge(keep_days: int = OUTBOX_KEEP_DAYS) -> int:
+    with dbc() as c:
+        return c.execute(
+            "DELETE FROM outbox WHERE status NOT IN ('pending','sending') AND created_at < NOW() - make_interval(days => %s)",
+            (keep_days,)
+        ).rowcount
+
+
+_OUTBOX_STATS = {"drains": 0, "claimed": 0, "last_drain": None}
+_OUTBOX_DRAIN_LOCK = asyncio.Lock()
+
+async def outbox_drain(bot) -> int:
+    """Відправляє все, що чекає в outbox. Повертає кількість оброблених рядків."""
+    if not DATABASE_URL or not LEADER.is_leader:
+        return 0
+    async with _OUTBOX_DRAIN_LOCK:
+        t0 = monotonic()
+        done = 0
+        while True:
+            batch = await run_db(outbox_claim, OUTBOX_BATCH, OUTBOX_LEASE)
+            if not batch:
+                break
+            report = await BROADCAST.send_all(bot, [(int(r["id"]), r["chat_id"], r["text"]) for r in batch])
+            await run_db(outbox_mark, report["outcomes"])
+            done += len(batch)
+        _OUTBOX_STATS["drains"] += 1
+        _OUTBOX_STATS["claimed"] += done
+        if done:
+            _OUTBOX_STATS["last_drain"] = {
+                "at": datetime.now(KYIV_TZ).isoformat(timespec="seconds"),
+                "rows": done, "duration_s": round(monotonic() - t0, 3),
+            }
+        return done
 
-    # Надіслати для щоденника за замовчуванням (11 клас)
-    text_11 = _build_morning_text(today, diary_id=None, schedule_key="11")
-    ids_11 = _get_diary_subscriber_ids(None)
-    await _broadcast(ctx.bot, text_11, ids_11)
 
-    # Надіслати для кожного кастомного щоденника
+# ==========================================
+# ⏰ JOBS
+# ==========================================
+async def _run_notification_job(bot, kind: str, today: date):
     try:
-        with dbc() as c:
-            diaries = c.execute("SELECT id, schedule_key FROM diaries").fetchall()
-        for d in diaries:
-            text = _build_morning_text(today, diary_id=int(d["id"]), schedule_key=d["schedule_key"] or "9")
-            ids = _get_diary_subscriber_ids(int(d["id"]))
-            await _broadcast(ctx.bot, text, ids)
+        messages = await run_db(_job_messages, kind, today)
+        n = await run_db(outbox_enqueue, messages)
+        log.info("📮 job_%s: %d повідомлень у черзі (%d щоденників)", kind, n, len(messages))
     except Exception as e:
-        log.error("job_morning diary error: %s", e)
+        log.error("job_%s error: %s", kind, e)
+    await outbox_drain(bot)
+
+
+async def job_morning(ctx: ContextTypes.DEFAULT_TYPE):
+    today = today_kyiv()
+    if today.weekday() >= 5:
+        return
+    await _run_notification_job(ctx.bot, "morning", today)
 
 
 async def job_evening(ctx: ContextTypes.DEFAULT_TYPE):
@@ -868,85 +2567,544 @@ async def job_evening(ctx: ContextTypes.DEFAULT_TYPE):
     tomorrow = today + timedelta(days=1)
     if tomorrow.weekday() >= 5:
         return
-
-    async def _send_evening(diary_id, schedule_key):
-        rows = hw_for_date_formatted(tomorrow.isoformat(), diary_id=diary_id)
-        important = [r for r in rows if r.get("is_important")]
-        if not important:
-            return
-        dn = DAYS_UA[tomorrow.weekday()]
-        text = f"🔴 *Важливе Д/З на завтра — {dn}, {tomorrow.strftime('%d.%m')}*\n{DIV}\n\n"
-        for r in important:
-            clip = " 📎" if r.get("attachments") else ""
-            text += f"╭─ {ei(r['subject'])} *{r['subject']}*{clip}\n│  📋 {r['description']}\n╰─ 👤 {r['author']}\n\n"
-        ids = _get_diary_subscriber_ids(diary_id)
-        await _broadcast(ctx.bot, text, ids)
-
-    await _send_evening(None, "11")
-    try:
-        with dbc() as c:
-            diaries = c.execute("SELECT id, schedule_key FROM diaries").fetchall()
-        for d in diaries:
-            await _send_evening(int(d["id"]), d["schedule_key"] or "9")
-    except Exception as e:
-        log.error("job_evening diary error: %s", e)
+    await _run_notification_job(ctx.bot, "evening", today)
 
 
 async def job_sunday_evening(ctx: ContextTypes.DEFAULT_TYPE):
     today = today_kyiv()
     if today.weekday() != 6:
         return
-    tomorrow = today + timedelta(days=1)
-    dn = DAYS_UA[tomorrow.weekday()]
+    await _run_notification_job(ctx.bot, "sunday", today)
+
+
+async def job_cleanup(ctx: ContextTypes.DEFAULT_TYPE):
+    n = await run_db(hw_cleanup)
+    if n:
+        log.info("🧹 Автоочищення: %d Д/З видалено", n)
+    n = await run_db(outbox_purge)
+    if n:
+        log.info("🧹 Outbox: %d старих рядків видалено", n)
+
+
+async def job_storage_gc(ctx: ContextTypes.DEFAULT_TYPE):
+    try:
+        res = await gc_storage_step()
+    except Exception as e:
+        log.error("job_storage_gc error: %s", e)
+        return
+    if res["deleted"] or res["freed"]:
+        log.info("♻️ Сховище: %d файлів без посилань видалено, звільнено %.1f МБ",
+                 res["deleted"], res["freed"] / 1024 / 1024)
+
+
+async def job_schedules_refresh(ctx: ContextTypes.DEFAULT_TYPE):
+    # Страховка на випадок пропущеного NOTIFY (перепідключення слухача тощо)
+    try:
+        await run_db(SCHEDULE_REGISTRY.refresh_if_stale)
+    except Exception as e:
+        log.error("job_schedules_refresh error: %s", e)
+
+
+async def job_outbox_drain(ctx: ContextTypes.DEFAULT_TYPE):
+    """Дочитує outbox після рестарту та підбирає рядки, чия оренда сплила."""
+    try:
+        await outbox_drain(ctx.bot)
+    except Exception as e:
+        log.error("job_outbox_drain error: %s", e)
+
+
+# ==========================================
+# 📥 ЧЕРГА ОНОВЛЕНЬ TELEGRAM
+# ==========================================
+# Webhook лише кладе оновлення в чергу і одразу відповідає 200 — Telegram не чекає на обробники
+# і не ретраїть повільні запити. Різні чати обробляються паралельно (не більше UPDATE_MAX_IN_FLIGHT
+# одночасно), оновлення одного чату — строго по черзі, у порядку надходження.
+def update_chat_key(update: object) -> int:
+    if not isinstance(update, Update):
+        return 0
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+class BoundedUpdateProcessor(BaseUpdateProcessor):
+    """Процесор оновлень PTB: не більше max_concurrent_updates обробників одночасно.
+
+    Порядок у межах чату тримає UpdateQueue — до процесора доходить щонайбільше
+    одне оновлення кожного чату, тож тут потрібен лише спільний ліміт.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.stats = {"processed": 0, "max_in_flight": 0}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.current_concurrent_updates)
+        try:
+            await coroutine
+        finally:
+            self.stats["processed"] += 1
 
-    async def _send_sunday(diary_id, schedule_key):
-        rows = hw_for_date_formatted(tomorrow.isoformat(), diary_id=diary_id)
-        has_imp = any(r.get("is_important") for r in rows)
-        if rows:
-            text = f"📋 *Д/З на завтра — {dn}, {tomorrow.strftime('%d.%m')}*\n{DIV}\n\n"
-            if has_imp:
-                text += "⚠️ *Є важливі завдання!*\n\n"
-            for r in rows:
-                imp  = "🔴 " if r.get("is_important") else ""
-                clip = " 📎" if r.get("attachments") else ""
-                text += f"╭─ {imp}{ei(r['subject'])} *{r['subject']}*{clip}\n│  📋 {r['description']}\n╰─ 👤 {r['author']}\n\n"
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class OfflineRequest(BaseRequest):
+    """Транспорт PTB без мережі для replay: на кожен виклик API — правдоподібна успішна відповідь.
+
+    Дає змогу навантажувати обробники записаними оновленнями, не чіпаючи Telegram
+    і не впираючись у його ліміти; REPLAY_API_LATENCY_MS імітує час відповіді API.
+    """
+
+    def __init__(self):
+        self._message_id = 0
+        self.calls: Dict[str, int] = {}
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": self._message_id,
+            "date": int(datetime.now(KYIV_TZ).timestamp()),
+            "chat": {"id": chat_id if isinstance(chat_id, int) else 0, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if REPLAY_API_LATENCY_MS:
+            await asyncio.sleep(REPLAY_API_LATENCY_MS / 1000)
+        params = request_data.parameters if request_data else {}
+        bot_user = {"id": 1, "is_bot": True, "first_name": "Offline", "username": "offline_bot"}
+        if endpoint == "getMe":
+            result: Any = bot_user
+        elif endpoint == "getUpdates":
+            result = []
+        elif endpoint == "getChatMember":
+            result = {"status": "member", "user": {"id": params.get("user_id", 0), "is_bot": False, "first_name": "User"}}
+        elif endpoint == "copyMessage":
+            result = {"message_id": self._message(params)["message_id"]}
+        elif endpoint.startswith("send") or endpoint.startswith("edit"):
+            result = self._message(params)
         else:
-            text = f"📋 *Д/З на завтра — {dn}, {tomorrow.strftime('%d.%m')}*\n{DIV}\n\n📭 На понеділок Д/З немає 🎉\nГарного відпочинку!\n"
-        ids = _get_diary_subscriber_ids(diary_id)
-        await _broadcast(ctx.bot, text, ids)
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+UPDATE_PROCESSOR = BoundedUpdateProcessor(max(1, UPDATE_MAX_IN_FLIGHT))
+OFFLINE_REQUEST = OfflineRequest() if BOT_RUN_MODE == "replay" and REPLAY_OFFLINE else None
 
-    await _send_sunday(None, "11")
+
+def build_ptb_app() -> Optional[Application]:
+    if not TOKEN:
+        return None
+    builder = Application.builder().token(TOKEN).concurrent_updates(UPDATE_PROCESSOR)
+    if OFFLINE_REQUEST is not None:
+        builder = builder.request(OFFLINE_REQUEST).get_updates_request(OfflineRequest())
+    return builder.build()
+
+
+ptb_app = build_ptb_app()
+
+
+class UpdateQueue:
+    """Вхідна черга: по задачі на активний чат, решта оновлень чату чекає в його deque.
+
+    Так оновлення, що чекають своєї черги в чаті, не займають слоти UPDATE_PROCESSOR —
+    слоти дістаються лише тим, хто реально може виконуватись.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.app: Optional[Application] = None
+        self._chats: Dict[int, deque] = {}
+        self._tasks: set = set()
+        self._pending = 0
+        self._drained = asyncio.Event()
+        self.stats = {"enqueued": 0, "processed": 0, "rejected": 0, "errors": 0,
+                      "max_depth": 0, "max_active_chats": 0, "max_chat_depth": 0, "max_lag_ms": 0}
+
+    def depth(self) -> int:
+        """Прийняті, але ще не оброблені оновлення (разом із тими, що виконуються)."""
+        return self._pending
+
+    def offer(self, update: Update) -> bool:
+        """Ставить оновлення в чергу; False — черга повна (webhook віддасть 503, Telegram повторить)."""
+        if self.app is None or self._pending >= self.maxsize:
+            self.stats["rejected"] += 1
+            return False
+        self._pending += 1
+        self._drained.clear()
+        self.stats["enqueued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self._pending)
+        key = update_chat_key(update)
+        item = (update, monotonic())
+        if key in self._chats:
+            self._chats[key].append(item)  # чат уже обробляється — стане в його чергу
+            self.stats["max_chat_depth"] = max(self.stats["max_chat_depth"], len(self._chats[key]))
+            return True
+        self._chats[key] = deque()
+        self.stats["max_active_chats"] = max(self.stats["max_active_chats"], len(self._chats))
+        task = asyncio.create_task(self._run_chat(self.app, key, item))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def put(self, update: Update) -> bool:
+        """Для polling і replay: замість відмови чекає місця в черзі — тиск передається джерелу."""
+        while self.app is not None and self._pending >= self.maxsize:
+            await asyncio.sleep(0.01)
+        return self.offer(update)
+
+    def start(self, app: Application):
+        self.app = app
+
+    async def _run_chat(self, app: Application, key: int, item):
+        while item is not None:
+            update, queued_at = item
+            lag_ms = int((monotonic() - queued_at) * 1000)
+            self.stats["max_lag_ms"] = max(self.stats["max_lag_ms"], lag_ms)
+            try:
+                await app.update_processor.process_update(update, app.process_update(update))
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                log.error("update %s error: %s", update.update_id, e)
+            finally:
+                self._pending -= 1
+                if not self._pending:
+                    self._drained.set()
+            chat_q = self._chats[key]
+            item = chat_q.popleft() if chat_q else None
+        del self._chats[key]
+
+    async def stop(self, timeout: float = 10.0):
+        # Дообробляємо вже прийняті оновлення: на них Telegram уже отримав 200
+        self.app = None
+        if self._pending:
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                log.warning("📥 Черга оновлень не спорожніла за %.0f с: %d втрачено", timeout, self._pending)
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+UPDATES = UpdateQueue(UPDATE_QUEUE_SIZE)
+
+# ==========================================
+# 👑 ЛІДЕР СЕРЕД ВОРКЕРІВ
+# ==========================================
+# HTTP і webhook обслуговує будь-який воркер, а щоденні розсилки, прибирання і set_webhook —
+# рівно один: власник session-level advisory lock. Lock живе разом із сесією, тож якщо лідер
+# падає чи втрачає з'єднання, Postgres звільняє його сам і наступний послідовник його підхоплює.
+LEADER_LOCK_KEY = 715_003
+LEADER_JOB_NAME = "leader"
+
+
+class LeaderElector:
+    def __init__(self, key: int):
+        self.key = key
+        self.is_leader = False
+        self._conn = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready = False  # on_elected відпрацював успішно для поточного лідерства
+        self.stats = {"elected": 0, "lost": 0, "since": None, "ready": False, "setup_errors": 0}
+
+    def _check(self) -> bool:
+        """Тримає лідерство або пробує його взяти. Виконується в потоці."""
+        try:
+            if self._conn is None or self._conn.closed:
+                self.is_leader = False
+                self._conn = psycopg2.connect(DATABASE_URL, application_name="tg-leader")
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                if self.is_leader:
+                    # Lock уже наш (повторний try_lock лише збільшив би лічильник) — перевіряємо сесію
+                    cur.execute("SELECT 1")
+                    return True
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+                return bool(cur.fetchone()[0])
+        except psycopg2.Error as e:
+            log.warning("leader check error: %s", e)
+            self._close()
+            return False
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()  # закриття сесії звільняє lock
+            except Exception:
+                pass
+            self._conn = None
+
+    async def start(self, on_elected, on_lost):
+        self._task = asyncio.create_task(self._loop(on_elected, on_lost))
+
+    async def _loop(self, on_elected, on_lost):
+        # Один процес / без БД — завжди лідер, але on_elected так само повторюється до успіху
+        single = not (LEADER_ELECTION and DATABASE_URL)
+        while True:
+            was = self.is_leader
+            now = True if single else await run_db(self._check)
+            self.is_leader = now
+            try:
+                if now and not was:
+                    self.stats["elected"] += 1
+                    self.stats["since"] = datetime.now(KYIV_TZ).isoformat(timespec="seconds")
+                    log.info("👑 Цей воркер — лідер (pid %d)", os.getpid())
+                elif was and not now:
+                    self._ready = False
+                    self.stats["lost"] += 1
+                    self.stats["since"] = None
+                    log.warning("👑 Лідерство втрачено (pid %d)", os.getpid())
+                    await on_lost()
+                if now and not self._ready:
+                    # Невдалий set_webhook/set_my_commands не лишає бота глухим: пробуємо знову
+                    await on_elected()
+                    self._ready = True
+            except Exception as e:
+                self.stats["setup_errors"] += 1
+                log.error("leader transition error: %s", e)
+            self.stats["ready"] = self._ready
+            await asyncio.sleep(LEADER_POLL_SEC if self._ready or not now else min(LEADER_POLL_SEC, 5))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await run_db(self._close)
+        self.is_leader = False
+        self._ready = False
+
+
+LEADER = LeaderElector(LEADER_LOCK_KEY)
+
+
+LEADER_DAILY_JOBS = [
+    (job_morning, time(hour=8, minute=0, tzinfo=KYIV_TZ)),
+    (job_evening, time(hour=18, minute=0, tzinfo=KYIV_TZ)),
+    (job_sunday_evening, time(hour=18, minute=0, tzinfo=KYIV_TZ)),
+    (job_cleanup, time(hour=0, minute=5, tzinfo=KYIV_TZ)),
+]
+
+
+def _missed_today(at: time, now: datetime) -> bool:
+    """Запуск сьогодні вже мав відбутися, але ще в межах LEADER_CATCHUP_HOURS."""
+    due = datetime.combine(now.date(), at.replace(tzinfo=None), tzinfo=KYIV_TZ)
+    return due <= now < due + timedelta(hours=LEADER_CATCHUP_HOURS)
+
+
+async def leader_start():
+    """Лише в лідера: щоденні задачі, прибирання сховища і налаштування бота в Telegram.
+
+    Ідемпотентна — LeaderElector повторює її, доки вона не відпрацює без помилок.
+    """
+    if not ptb_app:
+        return
+    jq = ptb_app.job_queue
+    if not jq.get_jobs_by_name(LEADER_JOB_NAME):
+        now = datetime.now(KYIV_TZ)
+        for job, at in LEADER_DAILY_JOBS:
+            jq.run_daily(job, time=at, name=LEADER_JOB_NAME)
+            # run_daily планує лише наступний день: пропущене під час failover доганяємо зараз,
+            # а run_key в outbox не дасть продублювати те, що попередній лідер уже поставив
+            if _missed_today(at, now):
+                jq.run_once(job, when=1, name=LEADER_JOB_NAME)
+        jq.run_repeating(job_storage_gc, interval=GC_INTERVAL_MIN * 60, first=120, name=LEADER_JOB_NAME)
+        jq.run_repeating(job_outbox_drain, interval=60, first=5, name=LEADER_JOB_NAME)
+
+    # getUpdates дозволено лише одному споживачу на токен — тому polling теж справа лідера
+    global _POLL_TASK
+    if BOT_RUN_MODE == "polling":
+        if _POLL_TASK is None or _POLL_TASK.done():
+            _POLL_TASK = asyncio.create_task(poll_updates())
+    else:
+        await set_webhook()
+
+    await ptb_app.bot.set_my_commands([
+        BotCommand("start", "🚀 Запустити бота"),
+        BotCommand("menu", "📚 Головне меню"),
+        BotCommand("schedule", "📆 Розклад уроків"),
+    ])
+    await ptb_app.bot.set_chat_menu_button(
+        menu_button=MenuButtonWebApp(
+            text="📱 Щоденник",
+            web_app=WebAppInfo(url=webapp_url())
+        )
+    )
+
+
+async def leader_stop():
+    global _POLL_TASK
+    if not ptb_app:
+        return
+    for job in ptb_app.job_queue.get_jobs_by_name(LEADER_JOB_NAME):
+        job.schedule_removal()
+    await _cancel_task(_POLL_TASK)
+    _POLL_TASK = None
+
+
+# ==========================================
+# 🔁 РЕЖИМИ ЗАПУСКУ: WEBHOOK / POLLING / REPLAY
+# ==========================================
+# webhook — прод: Telegram сам шле оновлення на WEBHOOK_URL.
+# polling — локальна розробка і середовища без публічної адреси: лідер тягне getUpdates.
+# replay  — навантажувальні прогони: оновлення з REPLAY_FILE йдуть у ту саму чергу, що й живі.
+_RUNNER_STATS = {"mode": BOT_RUN_MODE, "polled": 0, "poll_batches": 0, "poll_errors": 0,
+                 "replayed": 0, "replay_errors": 0, "replay_sec": None, "replay_rate": None}
+_POLL_TASK: Optional[asyncio.Task] = None
+_REPLAY_TASK: Optional[asyncio.Task] = None
+
+
+async def poll_updates():
+    """Long polling: getUpdates пачками до POLL_LIMIT, offset зсувається лише після постановки в чергу.
+
+    Будь-яка помилка Telegram (409 від іншого поллера чи залишеного webhook, невалідний токен, мережа)
+    лише логується з backoff — задача не завершується, поки її не скасує leader_stop.
+    """
+    bot = ptb_app.bot
+    log.info("🔁 Polling: limit=%d, timeout=%d с", POLL_LIMIT, POLL_TIMEOUT)
+    offset = None
+    attempt = 0
+    webhook_cleared = False
+    while True:
+        try:
+            if not webhook_cleared:
+                await bot.delete_webhook(drop_pending_updates=False)  # інакше getUpdates поверне 409
+                webhook_cleared = True
+            updates = await bot.get_updates(offset=offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT,
+                                            allowed_updates=Update.ALL_TYPES)
+            attempt = 0
+        except asyncio.CancelledError:
+            raise
+        except RetryAfter as ex:
+            ra = ex.retry_after
+            await asyncio.sleep(ra.total_seconds() if isinstance(ra, timedelta) else float(ra))
+            continue
+        except Exception as ex:
+            _RUNNER_STATS["poll_errors"] += 1
+            if isinstance(ex, Conflict):
+                webhook_cleared = False  # хтось поставив webhook або паралельно полить — пробуємо знову зняти
+            level = logging.WARNING if isinstance(ex, NetworkError) else logging.ERROR
+            log.log(level, "Polling retry (%d): %s: %s", attempt + 1, type(ex).__name__, ex)
+            await asyncio.sleep(min(2 ** attempt, 60))
+            attempt += 1
+            continue
+        if updates:
+            _RUNNER_STATS["poll_batches"] += 1
+        for update in updates:
+            if not await UPDATES.put(update):
+                return  # черга зупиняється — непоставлені оновлення Telegram віддасть наступному поллеру
+            offset = update.update_id + 1
+            _RUNNER_STATS["polled"] += 1
+
+
+def read_replay_file(path: str) -> List[dict]:
+    """Кожен непорожній рядок — JSON одного оновлення (як у тілі webhook)."""
+    items = []
+    with open(path, encoding="utf-8") as fh:
+        for lineno, line in enumerate(fh, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                _RUNNER_STATS["replay_errors"] += 1
+                log.warning("Replay %s:%d: %s", path, lineno, e)
+    return items
+
+
+async def replay_updates(path: str):
+    payloads = await FILES.run(read_replay_file, path)
+    total = len(payloads) * REPLAY_LOOPS
+    log.info("🔁 Replay: %d оновлень × %d з %s%s", len(payloads), REPLAY_LOOPS, path,
+             " (offline)" if OFFLINE_REQUEST is not None else "")
+    t0 = monotonic()
+    done_before = UPDATES.stats["processed"] + UPDATES.stats["errors"]
+    for _ in range(REPLAY_LOOPS):
+        for payload in payloads:
+            try:
+                update = Update.de_json(payload, ptb_app.bot)
+            except Exception as e:
+                _RUNNER_STATS["replay_errors"] += 1
+                log.warning("Replay: bad update: %s", e)
+                continue
+            if not await UPDATES.put(update):
+                return
+            _RUNNER_STATS["replayed"] += 1
+    # Чекаємо, доки черга дообробить усе програне, щоб час відображав обробку, а не лише постановку
+    while UPDATES.depth():
+        await asyncio.sleep(0.05)
+    elapsed = monotonic() - t0
+    handled = UPDATES.stats["processed"] + UPDATES.stats["errors"] - done_before
+    _RUNNER_STATS["replay_sec"] = round(elapsed, 3)
+    _RUNNER_STATS["replay_rate"] = round(handled / elapsed, 1) if elapsed else None
+    log.info("🔁 Replay завершено: %d/%d за %.2f с (%.1f оновл./с, помилок обробки: %d)",
+             handled, total, elapsed, _RUNNER_STATS["replay_rate"] or 0, UPDATES.stats["errors"])
+
+
+async def _cancel_task(task: Optional[asyncio.Task]):
+    if task is None:
+        return
+    task.cancel()
     try:
-        with dbc() as c:
-            diaries = c.execute("SELECT id, schedule_key FROM diaries").fetchall()
-        for d in diaries:
-            await _send_sunday(int(d["id"]), d["schedule_key"] or "9")
+        await task
+    except asyncio.CancelledError:
+        pass
     except Exception as e:
-        log.error("job_sunday_evening diary error: %s", e)
+        log.error("runner task error: %s", e)
 
 
-async def job_cleanup(ctx: ContextTypes.DEFAULT_TYPE):
-    n = hw_cleanup()
-    if n:
-        log.info("🧹 Автоочищення: %d Д/З видалено", n)
+async def set_webhook():
+    webhook_url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+    try:
+        if WEBHOOK_SECRET:
+            await ptb_app.bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+        else:
+            await ptb_app.bot.set_webhook(url=webhook_url, drop_pending_updates=False)
+    except TypeError:
+        await ptb_app.bot.set_webhook(webhook_url)
+    log.info('Webhook set to %s', webhook_url)
 
 
 # ==========================================
 # 🌐 FASTAPI
 # ==========================================
-ptb_app = Application.builder().token(TOKEN).build() if TOKEN else None
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_db()
+    await FILES.run(APP_PAGE.load)
+    missing = [kind for kind, ok in THUMB_BACKENDS.items() if not ok]
+    if missing:
+        log.warning("🖼 Прев'ю вимкнені для: %s (див. requirements.txt; для відео — ffmpeg)", ", ".join(missing))
+    await run_db(init_db)
+    HW_FEED.start_listener(asyncio.get_running_loop())
 
     if ptb_app:
         await ptb_app.initialize()
-        await ptb_app.bot.set_my_commands([
-            BotCommand("start", "🚀 Запустити бота"),
-            BotCommand("menu", "📚 Головне меню"),
-            BotCommand("schedule", "📆 Розклад уроків"),
-        ])
 
         global START_WEBAPP
         try:
@@ -956,13 +3114,6 @@ async def lifespan(app: FastAPI):
         except Exception:
             pass
 
-        await ptb_app.bot.set_chat_menu_button(
-            menu_button=MenuButtonWebApp(
-                text="📱 Щоденник",
-                web_app=WebAppInfo(url=WEB_APP_URL)
-            )
-        )
-
         ptb_app.add_handler(CommandHandler("start", cmd_start))
         ptb_app.add_handler(CommandHandler("menu", cmd_menu))
         ptb_app.add_handler(CommandHandler("schedule", cmd_schedule))
@@ -977,43 +3128,120 @@ async def lifespan(app: FastAPI):
         ptb_app.add_handler(CallbackQueryHandler(cb_sub_cancel, pattern="^sub_cancel$"))
         ptb_app.add_handler(CallbackQueryHandler(cb_help, pattern="^help$"))
 
-        jq = ptb_app.job_queue
-        jq.run_daily(job_morning, time=time(hour=8, minute=0, tzinfo=KYIV_TZ))
-        jq.run_daily(job_evening, time=time(hour=18, minute=0, tzinfo=KYIV_TZ))
-        jq.run_daily(job_sunday_evening, time=time(hour=18, minute=0, tzinfo=KYIV_TZ))
-        jq.run_daily(job_cleanup, time=time(hour=0, minute=5, tzinfo=KYIV_TZ))
+        # Розклади — локальний кеш кожного воркера; outbox розсилає лише лідер (див. leader_start).
+        # У replay немає ні того, ні іншого: offline-воркер не повинен чіпати спільний outbox.
+        if BOT_RUN_MODE != "replay":
+            ptb_app.job_queue.run_repeating(job_schedules_refresh, interval=SCHEDULE_POLL_SEC, first=SCHEDULE_POLL_SEC)
 
         await ptb_app.start()
-
-        if not WEBHOOK_URL:
-            raise RuntimeError("WEBHOOK_URL must be set")
-
-        webhook_url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
-        global WEBHOOK_SECRET_ACTIVE
-        WEBHOOK_SECRET_ACTIVE = False
-        try:
-            if WEBHOOK_SECRET:
-                await ptb_app.bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
-                WEBHOOK_SECRET_ACTIVE = True
-            else:
-                await ptb_app.bot.set_webhook(url=webhook_url, drop_pending_updates=False)
-        except TypeError:
-            await ptb_app.bot.set_webhook(webhook_url)
-        log.info('Webhook set to %s', webhook_url)
+        UPDATES.start(ptb_app)
+
+        if BOT_RUN_MODE == "replay":
+            # Навантажувальний прогін: без лідерства, outbox, щоденних розсилок і змін налаштувань бота
+            if not REPLAY_FILE:
+                raise RuntimeError("REPLAY_FILE must be set for BOT_RUN_MODE=replay")
+            global _REPLAY_TASK
+            _REPLAY_TASK = asyncio.create_task(replay_updates(REPLAY_FILE))
+        elif BOT_RUN_MODE == "polling":
+            await LEADER.start(on_elected=leader_start, on_lost=leader_stop)
+        elif BOT_RUN_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise RuntimeError("WEBHOOK_URL must be set")
+            # Секрет перевіряють усі воркери, а не лише той, що ставив webhook
+            global WEBHOOK_SECRET_ACTIVE
+            WEBHOOK_SECRET_ACTIVE = bool(WEBHOOK_SECRET)
+            await LEADER.start(on_elected=leader_start, on_lost=leader_stop)
+        else:
+            raise RuntimeError(f"Unknown BOT_RUN_MODE: {BOT_RUN_MODE}")
 
     yield
 
+    await LEADER.stop()
+    await _cancel_task(_POLL_TASK)
+    await _cancel_task(_REPLAY_TASK)
     if ptb_app:
+        await UPDATES.stop()
         await ptb_app.stop()
         await ptb_app.shutdown()
 
+    HW_FEED.stop_listener()
+    close_thumb_pool()
+    FILES.shutdown()
+    _DB_EXECUTOR.shutdown(wait=True)
+    close_db_pool()
+
 
 fastapi_app = FastAPI(lifespan=lifespan)
 
 
+class _UploadRejected(HTTPException):
+    pass
+
+
+class UploadSizeGuard:
+    """Обмежує тіло /api/upload ще під час прийому, до розбору multipart.
+
+    FastAPI спершу вичитує весь multipart у тимчасові файли і лише потім викликає api_upload,
+    тож перевірка в _save_upload сама по собі не завадить прийняти гігабайтне тіло. Тому тут:
+    завеликий Content-Length відхиляється одразу, а тіло без нього (chunked) чи з заниженим
+    значенням рахується по байтах і обривається, щойно перейде ліміт.
+    Чистий ASGI, а не @middleware("http"): решта запитів (SSE, файли) проходить без обгортки.
+    """
+
+    LIMIT_SLACK = 64 * 1024  # запас на multipart-межі та заголовки частин
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _too_large() -> JSONResponse:
+        return JSONResponse(
+            {"status":"error","message":f"Занадто великий upload (max {MAX_UPLOAD_MB}MB)"}, status_code=413)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/api/upload":
+            await self.app(scope, receive, send)
+            return
+        limit = MAX_UPLOAD_BYTES + self.LIMIT_SLACK
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > limit:
+                    await self._too_large()(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit and not rejected:
+                    rejected = True
+                    await self._too_large()(scope, receive, send)
+                    # HTTPException FastAPI не перетворює на 400 «error parsing the body» — розбір просто обривається
+                    raise _UploadRejected(status_code=413)
+            return message
+
+        async def guarded_send(message):
+            if not rejected:  # відповідь 413 уже надіслано — решту (обробник винятку) відкидаємо
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+
+fastapi_app.add_middleware(UploadSizeGuard)
+
+
 @fastapi_app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    if not ptb_app:
+    if not ptb_app or BOT_RUN_MODE != "webhook":
         return JSONResponse({"status": "no bot"}, status_code=503)
     if WEBHOOK_SECRET_ACTIVE:
         if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
@@ -1024,16 +3252,123 @@ async def telegram_webhook(request: Request):
     except Exception as e:
         log.warning('Bad webhook payload: %s', e)
         return JSONResponse({"status": "bad_request"}, status_code=400)
-    await ptb_app.process_update(update)
+    if not UPDATES.offer(update):
+        return JSONResponse({"status": "busy"}, status_code=503)
     return JSONResponse({"status": "ok"})
 
 
+# ── Mini App: шаблон читається й стискається один раз, далі віддається з пам'яті ──
+class AppPage:
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = 0.0
+        self.version = ""
+        self.etag = ""
+        self.bodies: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        mtime = os.path.getmtime(self.path)
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        bodies = {"br": brotli.compress(raw)} if brotli is not None else {}
+        bodies["gzip"] = gzip.compress(raw, 9)
+        bodies[""] = raw
+        with self._lock:
+            self.version = hashlib.sha256(raw).hexdigest()[:12]
+            self.etag = f'"{self.version}"'
+            self.bodies = bodies
+            self.mtime = mtime
+        log.info("🖼 Шаблон Mini App %s завантажено (версія %s, %d → %d байт gzip)",
+                 self.path, self.version, len(raw), len(bodies["gzip"]))
+
+    def get(self) -> "AppPage":
+        if not self.bodies:
+            self.load()
+        elif TEMPLATE_RELOAD:
+            try:
+                if os.path.getmtime(self.path) != self.mtime:
+                    self.load()
+            except OSError:
+                pass
+        return self
+
+    def body_for(self, accepted: set) -> tuple:
+        bodies = self.bodies
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in bodies:
+                return encoding, bodies[encoding]
+        return "", bodies[""]
+
+
+APP_PAGE = AppPage(TEMPLATE_PATH)
+
+
+def webapp_url() -> str:
+    """URL Mini App з версією шаблону — після деплою WebView не покаже стару сторінку з кешу."""
+    if not APP_PAGE.version:
+        return WEB_APP_URL
+    sep = "&" if "?" in WEB_APP_URL else "?"
+    return f"{WEB_APP_URL}{sep}v={APP_PAGE.version}"
+
+
+def _blob_etag(stored_name: str, st: os.stat_result) -> str:
+    # Ім'я блобу — це хеш вмісту, тож ETag сильний і без читання файлу
+    if _DERIVED_NAME_RE.match(stored_name):
+        return f'"{stored_name}"'
+    if _BLOB_NAME_RE.match(stored_name):
+        return f'"{stored_name[:64]}"'
+    return f'"{st.st_size:x}-{int(st.st_mtime):x}"'
+
+
+def _blob_variant(stored_name: str, path: str, encodings: set) -> Optional[tuple]:
+    """(шлях, кодування, ETag) для відповіді або None, якщо файлу немає. Виконується у пулі FILES."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    etag = _blob_etag(stored_name, st)
+    for enc_ext, encoding in _PRECOMPRESSED.items():
+        if encoding in encodings and os.path.exists(path + enc_ext):
+            return path + enc_ext, encoding, f'{etag[:-1]}-{encoding}"'
+    return path, "", etag
+
+
+def _accepted_encodings(request: Request) -> set:
+    out = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            out.add(name.lower())
+    return out
+
+
 @fastapi_app.get("/files/{stored_name}")
-async def get_file(stored_name: str):
-    path = os.path.join(UPLOAD_DIR, stored_name)
-    if not os.path.exists(path):
+async def get_file(request: Request, stored_name: str):
+    path = blob_path(stored_name)
+    # Вміст за цим ім'ям ніколи не змінюється → кешуємо назавжди
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    media_type = mimetypes.guess_type(stored_name)[0] or "application/octet-stream"
+
+    # Стиснута копія — лише для повної відповіді; Range завжди рахується по оригіналу
+    encodings: set = set()
+    if os.path.splitext(stored_name)[1] in _TEXT_EXTS:
+        headers["Vary"] = "Accept-Encoding"
+        if "range" not in request.headers:
+            encodings = _accepted_encodings(request)
+
+    variant = await FILES.run(_blob_variant, stored_name, path, encodings) if path else None
+    if not variant:
         return JSONResponse({"status": "error", "message": "File not found"}, status_code=404)
-    return FileResponse(path, filename=stored_name)
+    serve_path, encoding, etag = variant
+    headers["ETag"] = etag
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return FileResponse(serve_path, media_type=media_type, headers=headers)
+    # FileResponse сам обробляє Range/If-Range (206, 416) і Accept-Ranges
+    return FileResponse(serve_path, filename=stored_name, media_type=media_type, headers=headers)
 
 
 @fastapi_app.head("/")
@@ -1042,26 +3377,33 @@ async def head_root():
 
 
 @fastapi_app.get("/", response_class=HTMLResponse)
-async def read_root():
-    with open("templates/index.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def read_root(request: Request, v: Optional[str] = None):
+    page = APP_PAGE.get()
+    # Посилання з ?v=<поточна версія> незмінне → WebView може кешувати його назавжди
+    if v and v == page.version:
+        cache = "public, max-age=31536000, immutable"
+    else:
+        cache = "no-cache"
+    encoding, body = page.body_for(_accepted_encodings(request))
+    etag = f'"{page.version}-{encoding}"' if encoding else page.etag
+    headers = {"ETag": etag, "Cache-Control": cache, "Vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="text/html; charset=utf-8", headers=headers)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # 📡 API — USER CONTEXT
 # ─────────────────────────────────────────────────────────────────────────────
-@fastapi_app.get("/api/user_context")
-async def api_user_context(user_id: Optional[int] = None, diary_id: Optional[int] = None):
+def _user_context_payload(user_id: Optional[int], diary_id: Optional[int]) -> dict:
     is_super_admin = (user_id == DEFAULT_ADMIN_ID)
 
     # Супер-адмін може переключатись між щоденниками через diary_id
     if is_super_admin and diary_id is not None:
         try:
-            with dbc() as c:
-                row = c.execute(
-                    "SELECT id, name, grade, schedule_key FROM diaries WHERE id=%s",
-                    (diary_id,)
-                ).fetchone()
+            row = diary_get(diary_id)
             if row:
                 ctx = {
                     "diary_id": int(row["id"]),
@@ -1083,37 +3425,27 @@ async def api_user_context(user_id: Optional[int] = None, diary_id: Optional[int
 
     schedule_key = ctx["schedule_key"]
     today = today_kyiv()
-    if schedule_key == "9":
-        schedule = get_resolved_schedule_9(today)
-    else:
-        schedule = SCHEDULES.get(schedule_key, SCHEDULE_11)
+    schedule = resolved_schedule(schedule_key, today)
     mix_info = None
-    if schedule_key == "9":
-        mix = resolve_mix_for_week(today)
+    if SCHEDULE_REGISTRY.get(schedule_key)["mix"]:
+        mix = resolve_mix(schedule_key, today)
         mix_info = mix or "Немає уроку"
 
     # Знаходимо admin_id щоденника
-    diary_admin_id = None
+    admin_id = None
     if ctx["diary_id"] is not None:
         try:
-            with dbc() as c:
-                row = c.execute(
-                    "SELECT user_id FROM diary_members WHERE diary_id=%s AND role='admin' LIMIT 1",
-                    (ctx["diary_id"],)
-                ).fetchone()
-                if row:
-                    diary_admin_id = int(row["user_id"])
+            admin_id = diary_admin_id(ctx["diary_id"])
         except Exception:
             pass
-    if diary_admin_id is None:
-        diary_admin_id = DEFAULT_ADMIN_ID
+    if admin_id is None:
+        admin_id = DEFAULT_ADMIN_ID
 
     # Список усіх щоденників для супер-адміна
     available_diaries = None
     if is_super_admin:
         try:
-            with dbc() as c:
-                rows = c.execute("SELECT id, name, grade FROM diaries ORDER BY id").fetchall()
+            rows = diaries_all()
             available_diaries = [{"id": int(r["id"]), "name": r["name"], "grade": r["grade"]} for r in rows]
             # Додаємо 11 клас як перший варіант (diary_id=null)
             available_diaries = [{"id": None, "name": "11 клас", "grade": "11"}] + available_diaries
@@ -1124,97 +3456,214 @@ async def api_user_context(user_id: Optional[int] = None, diary_id: Optional[int
         "diary_id": ctx["diary_id"],
         "is_diary_admin": ctx["is_diary_admin"],
         "is_super_admin": is_super_admin,
-        "diary_admin_id": diary_admin_id,
+        "diary_admin_id": admin_id,
         "grade": ctx["grade"],
         "schedule_key": schedule_key,
         "name": ctx["name"],
         "schedule": schedule,
+        "bells": SCHEDULE_REGISTRY.get(schedule_key)["bells"],
         "mix_info": mix_info,
         "available_diaries": available_diaries,
     }
 
 
+@fastapi_app.get("/api/user_context")
+async def api_user_context(user_id: Optional[int] = None, diary_id: Optional[int] = None):
+    return await run_db(_user_context_payload, user_id, diary_id)
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # 📡 API — HOMEWORK
 # ─────────────────────────────────────────────────────────────────────────────
-@fastapi_app.get("/api/hw")
-async def get_hw_api(user_id: Optional[int] = None):
-    ctx = get_user_diary_context(user_id)
-    diary_id = ctx["diary_id"]
-    today = today_kyiv()
+def _hw_window_from_rows(rows: list, today: date) -> dict:
+    days = [today + timedelta(days=i) for i in range(3)]
     data = {}
-    for i in range(3):
-        target_date = today + timedelta(days=i)
+    for i, target_date in enumerate(days):
         iso_date = target_date.isoformat()
         label = "Сьогодні" if i == 0 else "Завтра" if i == 1 else target_date.strftime('%d.%m')
-        data[iso_date] = {"label": label, "tasks": hw_for_date_formatted(iso_date, diary_id=diary_id)}
+        data[iso_date] = {"label": label, "tasks": [r for r in rows if r["date"] == iso_date]}
     return data
 
 
-@fastapi_app.get("/api/hw_all")
-async def get_hw_all_api(user_id: Optional[int] = None):
+def _hw_window(user_id: Optional[int]) -> dict:
+    ctx = get_user_diary_context(user_id)
+    today = today_kyiv()
+    rows = hw_range(today.isoformat(), (today + timedelta(days=2)).isoformat(), diary_id=ctx["diary_id"])
+    return _hw_window_from_rows(rows, today)
+
+
+def _hw_all(user_id: Optional[int]) -> list:
     ctx = get_user_diary_context(user_id)
+    return hw_range(today_kyiv().isoformat(), diary_id=ctx["diary_id"])
+
+
+def _hw_snapshot(diary_id: Optional[int]) -> dict:
+    """Обидва представлення (/api/hw та /api/hw_all) з одного запиту."""
+    today = today_kyiv()
+    rows = hw_range(today.isoformat(), diary_id=diary_id)
+    return {"hw": _hw_window_from_rows(rows, today), "hw_all": rows}
+
+
+def _hw_etag(diary_id: Optional[int], version_tag: str) -> str:
+    return f'W/"hw-{diary_id if diary_id is not None else 0}-{version_tag}-{today_kyiv().isoformat()}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    if inm.strip() == "*":
+        return True
+    strip = lambda t: t.strip().removeprefix("W/")
+    return strip(etag) in {strip(t) for t in inm.split(",")}
+
+
+@fastapi_app.get("/api/hw_snapshot")
+async def get_hw_snapshot_api(request: Request, user_id: Optional[int] = None):
+    if not DATABASE_URL:
+        return {"hw": {}, "hw_all": []}
+    ctx = await run_db(get_user_diary_context, user_id)
+    # ETag рахуємо ДО читання даних: запис, що встигне між ними, лише змусить клієнта перезавантажити ще раз
+    if HW_FEED_NOTIFY:
+        etag = _hw_etag(ctx["diary_id"], hw_version_tag(ctx["diary_id"]))  # без БД
+    else:
+        etag = _hw_etag(ctx["diary_id"], f"db{await run_db(hw_version_db, ctx['diary_id'])}")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    data = await run_db(_hw_snapshot, ctx["diary_id"])
+    return JSONResponse(data, headers=headers)
+
+
+@fastapi_app.get("/api/hw_stream")
+async def hw_stream_api(request: Request, user_id: Optional[int] = None):
+    """SSE: події upsert/delete/resync для щоденника користувача."""
+    ctx = await run_db(get_user_diary_context, user_id)
     diary_id = ctx["diary_id"]
-    today = today_kyiv().isoformat()
+
+    async def events():
+        # Підписка всередині генератора: якщо клієнт відвалиться до першої ітерації,
+        # генератор не стартує — і не лишить по собі черги в HW_FEED, яку ніхто не читає
+        q = HW_FEED.subscribe(diary_id)
+        try:
+            yield "retry: 5000\nevent: hello\ndata: {}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(q.get(), HW_FEED_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: hw\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            HW_FEED.unsubscribe(diary_id, q)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@fastapi_app.get("/api/hw")
+async def get_hw_api(user_id: Optional[int] = None):
+    return await run_db(_hw_window, user_id)
+
+
+@fastapi_app.get("/api/hw_all")
+async def get_hw_all_api(user_id: Optional[int] = None):
     if not DATABASE_URL:
         return []
-    with dbc() as c:
-        if diary_id is None:
-            rows = c.execute("""
-                SELECT id, subject, description, author_name, author_id, due_date, is_important
-                FROM homework
-                WHERE due_date >= %s AND diary_id IS NULL
-                ORDER BY due_date, is_important DESC, subject
-            """, (today,)).fetchall()
-        else:
-            rows = c.execute("""
-                SELECT id, subject, description, author_name, author_id, due_date, is_important
-                FROM homework
-                WHERE due_date >= %s AND diary_id=%s
-                ORDER BY due_date, is_important DESC, subject
-            """, (today, diary_id)).fetchall()
+    return await run_db(_hw_all, user_id)
 
-    ids = [int(r["id"]) for r in rows]
-    att_map = _attachments_for_hw_ids(ids)
 
-    return [{
-        "id": int(r["id"]),
-        "subject": r["subject"],
-        "description": r["description"],
-        "author": r["author_name"] or "—",
-        "author_id": r["author_id"],
-        "date": r["due_date"],
-        "is_important": int(r["is_important"] or 0),
-        "attachments": att_map.get(int(r["id"]), [])
-    } for r in rows]
+class UploadTooLarge(Exception):
+    pass
+
+
+_BACKGROUND_TASKS: set = set()
+
+def _spawn_background(coro):
+    # Тримаємо посилання, інакше незавершену задачу може зібрати GC
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+async def _save_upload(f: UploadFile, budget: int) -> tuple:
+    """Копіює upload шматками у тимчасовий файл, рахуючи sha256 на льоту.
+
+    На цей момент тіло вже прийняте (його розмір обмежує UploadSizeGuard); тут перевіряється
+    сумарний бюджет файлів запиту, і копіювання у сховище обривається, щойно його перевищено.
+    Готовий файл переноситься у сховище під іменем-хешем; повертає (stored_name, size, sha256, created).
+    """
+    token = secrets.token_hex(16)
+    stored, created = "", False
+    tmp_path = os.path.join(UPLOAD_DIR, f".{token}.part")
+    digest = hashlib.sha256()
+    size = 0
+    out = await FILES.run(open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await f.read(UPLOAD_CHUNK_KB * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > budget:
+                raise UploadTooLarge()
+            digest.update(chunk)
+            await FILES.run(out.write, chunk)
+        await FILES.run(out.close)
+        if size:
+            stored, created = await FILES.run(blob_commit, tmp_path, digest.hexdigest(), _safe_ext(f.filename))
+            if created:
+                await FILES.run(precompress_blob, blob_path(stored))
+        else:
+            FILES.discard([tmp_path])
+    except BaseException:
+        # Тут можна опинитись і через скасування задачі — не чекаємо, лише ставимо в чергу
+        out.close()
+        FILES.discard([tmp_path])
+        raise
+    return stored, size, digest.hexdigest(), created
 
 
 @fastapi_app.post("/api/upload")
 async def api_upload(files: List[UploadFile] = File(...)):
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
     uploaded = []
     total = 0
-    for f in files:
-        data = await f.read()
-        size = len(data)
-        total += size
-        if size == 0:
-            continue
-        if total > MAX_UPLOAD_BYTES:
-            return JSONResponse({"status":"error","message":f"Занадто великий upload (max {MAX_UPLOAD_MB}MB)"}, status_code=413)
-        ext = _safe_ext(f.filename)
-        token = secrets.token_hex(16)
-        stored = f"{token}{ext}"
-        path = os.path.join(UPLOAD_DIR, stored)
-        with open(path, "wb") as out:
-            out.write(data)
-        uploaded.append({
-            "name": f.filename, "stored_name": stored,
-            "url": f"/files/{stored}", "mime": f.content_type or "", "size": size,
-        })
+    try:
+        for f in files:
+            stored, size, sha, created = await _save_upload(f, MAX_UPLOAD_BYTES - total)
+            if size == 0:
+                continue
+            total += size
+            uploaded.append({
+                "name": f.filename, "stored_name": stored, "sha256": sha, "deduplicated": not created,
+                "url": f"/files/{stored}", "mime": f.content_type or "", "size": size,
+            })
+        # Прев'ю генеруються у фоні — відповідь upload їх не чекає
+        for u in uploaded:
+            if not u["deduplicated"]:
+                _spawn_background(generate_thumbnail(u["stored_name"]))
+    except UploadTooLarge:
+        # Уже збережені блоби не видаляємо напряму: паралельний upload того самого вмісту міг
+        # дедуплікуватись на них і прив'язати до Д/З. Без посилань їх прибере GC після UPLOAD_GRACE_MIN.
+        return JSONResponse({"status":"error","message":f"Занадто великий upload (max {MAX_UPLOAD_MB}MB)"}, status_code=413)
     return {"status": "ok", "files": uploaded}
 
 
+_DUE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+def _valid_due(due) -> bool:
+    # date.fromisoformat у 3.11 приймає й 20240101 чи 2024-W01-1, які Postgres може відкинути —
+    # тоді замість 400 вийшла б 500; тож спершу строгий формат YYYY-MM-DD
+    if not isinstance(due, str) or not _DUE_RE.fullmatch(due):
+        return False
+    try:
+        date.fromisoformat(due)
+        return True
+    except ValueError:
+        return False
+
+
 @fastapi_app.post("/api/hw_add")
 async def api_add_hw(request: Request):
     data = await request.json()
@@ -1226,32 +3675,10 @@ async def api_add_hw(request: Request):
     attachments = data.get("attachments") or []
     is_important = int(data.get("is_important") or 0)
 
-    # Визначаємо diary_id з контексту користувача
-    user_id = int(author_id) if author_id else None
-    ctx = get_user_diary_context(user_id)
-    diary_id = ctx["diary_id"]
-
+    if due and not _valid_due(due):
+        return {"status": "error", "message": "Invalid date"}
     if subject and desc and due:
-        with dbc() as c:
-            cur = c.execute("""
-                INSERT INTO homework(subject, description, due_date, author_name, author_id, is_important, diary_id)
-                VALUES(%s,%s,%s,%s,%s,%s,%s) RETURNING id
-            """, (subject, desc, due, author, author_id, is_important, diary_id))
-            hw_id = cur.fetchone()["id"]
-            for a in attachments:
-                stored_name = a.get("stored_name")
-                orig = a.get("name") or "file"
-                mime = a.get("mime") or ""
-                size = int(a.get("size") or 0)
-                if not stored_name:
-                    continue
-                path = os.path.join(UPLOAD_DIR, stored_name)
-                if not os.path.exists(path):
-                    continue
-                c.execute("""
-                    INSERT INTO attachments(hw_id, original_name, stored_name, mime_type, size_bytes)
-                    VALUES(%s,%s,%s,%s,%s) ON CONFLICT (stored_name) DO NOTHING
-                """, (hw_id, orig, stored_name, mime, size))
+        await run_db(hw_add, subject, desc, due, author, author_id, is_important, attachments)
     return {"status": "ok"}
 
 
@@ -1261,11 +3688,7 @@ async def api_delete_hw(request: Request):
     hw_id = data.get("id")
     if not hw_id:
         return {"status": "error", "message": "No ID provided"}
-    with dbc() as c:
-        rows = c.execute("SELECT stored_name FROM attachments WHERE hw_id=%s", (hw_id,)).fetchall()
-        for r in rows:
-            _delete_file_quiet(r["stored_name"])
-        c.execute("DELETE FROM homework WHERE id=%s", (hw_id,))
+    await run_db(hw_delete, hw_id)
     return {"status": "ok"}
 
 
@@ -1280,34 +3703,9 @@ async def api_update_hw(request: Request):
     is_important = int(data.get("is_important") or 0)
     if not hw_id:
         return {"status": "error", "message": "No ID provided"}
-    if not (subject and due and desc):
+    if not (subject and due and desc) or not _valid_due(due):
         return {"status": "error", "message": "Invalid data"}
-    with dbc() as c:
-        c.execute("""
-            UPDATE homework SET subject=%s, due_date=%s, description=%s, is_important=%s
-            WHERE id=%s
-        """, (subject, due, desc, is_important, hw_id))
-        if attachments is not None:
-            kept_names = {a.get("stored_name") for a in (attachments or []) if a.get("stored_name")}
-            old = c.execute("SELECT stored_name FROM attachments WHERE hw_id=%s", (hw_id,)).fetchall()
-            for r in old:
-                if r["stored_name"] not in kept_names:
-                    _delete_file_quiet(r["stored_name"])
-            c.execute("DELETE FROM attachments WHERE hw_id=%s", (hw_id,))
-            for a in (attachments or []):
-                stored_name = a.get("stored_name")
-                orig = a.get("name") or "file"
-                mime = a.get("mime") or ""
-                size = int(a.get("size") or 0)
-                if not stored_name:
-                    continue
-                path = os.path.join(UPLOAD_DIR, stored_name)
-                if not os.path.exists(path):
-                    continue
-                c.execute("""
-                    INSERT INTO attachments(hw_id, original_name, stored_name, mime_type, size_bytes)
-                    VALUES(%s,%s,%s,%s,%s) ON CONFLICT (stored_name) DO NOTHING
-                """, (hw_id, orig, stored_name, mime, size))
+    await run_db(hw_update, hw_id, subject, due, desc, is_important, attachments)
     return {"status": "ok"}
 
 
@@ -1318,10 +3716,10 @@ async def api_update_hw(request: Request):
 async def api_diary_members(user_id: Optional[int] = None):
     if not user_id:
         return JSONResponse({"status": "error", "message": "user_id required"}, status_code=400)
-    ctx = get_user_diary_context(user_id)
+    ctx = await run_db(get_user_diary_context, user_id)
     if not ctx["is_diary_admin"] or ctx["diary_id"] is None:
         return JSONResponse({"status": "error", "message": "Not a diary admin"}, status_code=403)
-    members = diary_get_members(ctx["diary_id"])
+    members = await run_db(diary_get_members, ctx["diary_id"])
     return {
         "diary_id": ctx["diary_id"],
         "diary_name": ctx["name"],
@@ -1343,14 +3741,14 @@ async def api_diary_add_member(request: Request):
     if not admin_id or not new_uid:
         return JSONResponse({"status": "error", "message": "admin_user_id and user_id required"}, status_code=400)
 
-    ctx = get_user_diary_context(int(admin_id))
+    ctx = await run_db(get_user_diary_context, int(admin_id))
     if not ctx["is_diary_admin"] or ctx["diary_id"] is None:
         return JSONResponse({"status": "error", "message": "Not a diary admin"}, status_code=403)
 
     if role not in ("member", "admin"):
         role = "member"
 
-    ok = diary_add_member(ctx["diary_id"], int(new_uid), role)
+    ok = await run_db(diary_add_member, ctx["diary_id"], int(new_uid), role)
     return {"status": "ok" if ok else "error"}
 
 
@@ -1363,14 +3761,14 @@ async def api_diary_remove_member(request: Request):
     if not admin_id or not target_uid:
         return JSONResponse({"status": "error", "message": "admin_user_id and user_id required"}, status_code=400)
 
-    ctx = get_user_diary_context(int(admin_id))
+    ctx = await run_db(get_user_diary_context, int(admin_id))
     if not ctx["is_diary_admin"] or ctx["diary_id"] is None:
         return JSONResponse({"status": "error", "message": "Not a diary admin"}, status_code=403)
 
     if int(target_uid) == int(admin_id):
         return JSONResponse({"status": "error", "message": "Cannot remove yourself"}, status_code=400)
 
-    ok = diary_remove_member(ctx["diary_id"], int(target_uid))
+    ok = await run_db(diary_remove_member, ctx["diary_id"], int(target_uid))
     return {"status": "ok" if ok else "error"}
 
 
@@ -1380,10 +3778,10 @@ async def api_create_invite(request: Request):
     admin_id = data.get("admin_user_id")
     if not admin_id:
         return JSONResponse({"status": "error", "message": "admin_user_id required"}, status_code=400)
-    ctx = get_user_diary_context(int(admin_id))
+    ctx = await run_db(get_user_diary_context, int(admin_id))
     if not ctx["is_diary_admin"] or ctx["diary_id"] is None:
         return JSONResponse({"status": "error", "message": "Not a diary admin"}, status_code=403)
-    code = create_diary_invite(ctx["diary_id"])
+    code = await run_db(create_diary_invite, ctx["diary_id"])
     bot_username = None
     try:
         bot_username = (await ptb_app.bot.get_me()).username if ptb_app else None
@@ -1393,6 +3791,35 @@ async def api_create_invite(request: Request):
     return {"status": "ok", "code": code, "link": link}
 
 
+def _diary_set_schedule(diary_id: int, days: dict, bells, mix_rules) -> str:
+    key = f"d{diary_id}"
+    schedule_save(key, days, bells, mix_rules)
+    with dbc() as c:
+        c.execute("UPDATE diaries SET schedule_key=%s WHERE id=%s", (key, diary_id))
+    # schedule_key входить у кешований контекст учасників
+    for m in diary_get_members(diary_id):
+        invalidate_user_context(int(m["user_id"]))
+    return key
+
+
+@fastapi_app.post("/api/diary/schedule")
+async def api_diary_schedule(request: Request):
+    data = await request.json()
+    admin_id = data.get("admin_user_id")
+    if not admin_id:
+        return JSONResponse({"status": "error", "message": "admin_user_id required"}, status_code=400)
+    ctx = await run_db(get_user_diary_context, int(admin_id))
+    if not ctx["is_diary_admin"] or ctx["diary_id"] is None:
+        return JSONResponse({"status": "error", "message": "Not a diary admin"}, status_code=403)
+
+    days, bells, mix_rules = data.get("days"), data.get("bells"), data.get("mix_rules")
+    error = validate_schedule(days, bells, mix_rules)
+    if error:
+        return JSONResponse({"status": "error", "message": error}, status_code=400)
+    key = await run_db(_diary_set_schedule, ctx["diary_id"], days, bells, mix_rules)
+    return {"status": "ok", "schedule_key": key, "version": SCHEDULE_REGISTRY.version}
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # 📡 Ping / Favicon
 # ─────────────────────────────────────────────────────────────────────────────
@@ -1400,6 +3827,42 @@ async def api_create_invite(request: Request):
 async def ping():
     return {"status": "alive", "timestamp": datetime.now(KYIV_TZ).isoformat()}
 
+def _metrics_allowed(request: Request) -> bool:
+    # З METRICS_TOKEN — лише з токеном (Bearer або X-Metrics-Token); без нього — лише з localhost
+    if METRICS_TOKEN:
+        auth = request.headers.get("authorization", "")
+        given = auth[7:] if auth.lower().startswith("bearer ") else request.headers.get("x-metrics-token", "")
+        return hmac.compare_digest(given.encode(), METRICS_TOKEN.encode())
+    host = request.client.host if request.client else ""
+    return host in ("127.0.0.1", "::1", "localhost")
+
+
+@fastapi_app.get("/metrics")
+async def metrics(request: Request):
+    if not _metrics_allowed(request):
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    return {
+        "db_pool": DB_POOL.stats() if DB_POOL else None,
+        "db_executor": dict(_DB_EXEC_STATS),
+        "user_context_cache": _CTX_CACHE.stats(),
+        "outbox": _OUTBOX_STATS,
+        "broadcast": {"totals": BROADCAST.totals, "last_run": BROADCAST.last_report},
+        "hw_feed": {**HW_FEED.stats, "subscribers": HW_FEED.subscriber_count()},
+        "thumbnails": {**_THUMB_STATS, "backends": THUMB_BACKENDS},
+        "storage_gc": {**_GC_STATS, "cursor": _GC_STATE["cursor"]},
+        "hw_cleanup": _CLEANUP_STATS,
+        "files": FILES.stats,
+        "leader": {**LEADER.stats, "is_leader": LEADER.is_leader, "pid": os.getpid()},
+        "updates": {
+            **UPDATES.stats, "depth": UPDATES.depth(),
+            "active_chats": len(UPDATES._chats),
+            "in_flight": UPDATE_PROCESSOR.current_concurrent_updates,
+            "max_in_flight_limit": UPDATE_PROCESSOR.max_concurrent_updates,
+            "processor": UPDATE_PROCESSOR.stats,
+        },
+        "runner": {**_RUNNER_STATS, **({"api_calls": OFFLINE_REQUEST.calls} if OFFLINE_REQUEST else {})},
+    }
+
 @fastapi_app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     return Response(status_code=204)
@@ -1409,5 +3872,15 @@ async def favicon():
 # 🚀 RUN
 # ==========================================
 if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["check-plans"]:
+        # CI/ручна перевірка: ненульовий код виходу, якщо якийсь ключовий запит втратив індекс
+        init_db()
+        problems = check_query_plans()
+        for p in problems:
+            print("❌", p)
+        print("✅ Усі ключові запити використовують індекси" if not problems else "")
+        sys.exit(1 if problems else 0)
+
     import uvicorn
     uvicorn.run(fastapi_app, host="0.0.0.0", port=8000)